@@ -1,24 +1,83 @@
 # backend/agent.py
 
 import os
-import google.generativeai as genai
-from PIL import Image
-import io
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, Optional
+import json
 import base64
 from datetime import datetime
 from dotenv import load_dotenv
 
 # Import our RAG tool
-from rag_tool import retrieve_context
+from rag_tool import retrieve_chunks
+import prompt_context
+import metrics
+import resilience
+
+KNOWLEDGE_BASE_PATH = "knowledge_base"
 
 # Load environment variables from the.env file
 load_dotenv()
 
-# Configure the Gemini API with the key from our.env file
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY not found in.env file")
-genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+
+# --- Gemini Model ---
+# google.generativeai takes most of a second to import, so it is loaded on first
+# use (or by the startup warm-up) and a single model object serves every request.
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Returns the shared Gemini model, importing and configuring the SDK on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                if not GEMINI_API_KEY:
+                    raise ValueError("GEMINI_API_KEY not found in.env file")
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                _model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return _model
+
+
+def set_model(model):
+    """Swaps the shared model, e.g. for a fake one in benchmarks; None reloads Gemini on next use."""
+    global _model
+    with _model_lock:
+        _model = model
+
+# --- Model Concurrency Limits ---
+# At most MODEL_MAX_CONCURRENCY analyses talk to Gemini at once; a request that
+# can't get a slot within MODEL_QUEUE_TIMEOUT seconds is turned away instead of queueing.
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "8"))
+MODEL_THREAD_POOL_SIZE = int(os.getenv("MODEL_THREAD_POOL_SIZE", str(MODEL_MAX_CONCURRENCY)))
+MODEL_QUEUE_TIMEOUT = float(os.getenv("MODEL_QUEUE_TIMEOUT", "0.5"))
+MODEL_RETRY_AFTER = int(os.getenv("MODEL_RETRY_AFTER", "5"))
+
+_model_executor = ThreadPoolExecutor(max_workers=MODEL_THREAD_POOL_SIZE, thread_name_prefix="gemini")
+_model_slots = asyncio.Semaphore(MODEL_MAX_CONCURRENCY)
+
+
+class AgentBusyError(Exception):
+    """Raised when every model slot is taken and the client should retry later."""
+
+    def __init__(self, retry_after: int = MODEL_RETRY_AFTER):
+        super().__init__("The analysis service is busy. Please try again shortly.")
+        self.retry_after = retry_after
+
+
+# --- Helper function to decode the uploaded image ---
+def decode_image_data(image_base64: str) -> bytes:
+    """Decodes a base64 image, with or without the 'data:image/...;base64,' prefix."""
+    with metrics.timed("image_decode"):
+        return base64.b64decode(image_base64.split(',', 1)[-1])
 
 # --- Helper function to determine language ---
 def get_language_name(code: str) -> str:
@@ -27,36 +86,41 @@ def get_language_name(code: str) -> str:
         return "Kannada"
     return "English"
 
-# --- The "Detective" Agent (Updated) ---
-def run_analysis_agent(image_base64: str, user_query: str, farm_details: dict, language_code: str) -> dict:
+def normalize_language_code(code: Optional[str]) -> str:
+    """The lowercase primary subtag of a language tag ('kn-IN' -> 'kn'); 'en' when it isn't one."""
+    primary = (code or "").replace("_", "-").split("-")[0].strip().lower()
+    return primary if 2 <= len(primary) <= 3 and primary.isalpha() else "en"
+
+# --- Helper function to fetch hyper-local context ---
+def retrieve_local_context(user_query: str, crop_type: Optional[str] = None) -> str:
     """
-    This is the core agentic function. It gathers context and uses Gemini Vision
-    to perform an expert-level analysis in the requested language.
+    Retrieves the knowledge-base passages relevant to the farmer's observation,
+    fitted to the context token budget (see prompt_context).
     """
-    print("🕵️ Agent Activated: Starting investigation...")
-
-    # --- Step 1: "Checking the Records" (Fetching Farm History) ---
-    farm_history = f"This farm is located in {farm_details.get('location', 'Kodagu')} and primarily grows {farm_details.get('crop_type', 'Robusta Coffee')}. Past issues are not yet recorded."
-    print(f"   -> Fetched Farm History: {farm_history}")
-
-    # --- Step 2: "Surveying the Scene" (Retrieving Hyper-Local Context with RAG) ---
     rag_query = user_query if user_query else "coffee pepper disease management"
-    local_context = retrieve_context(rag_query, "knowledge_base")
-    print(f"   -> Retrieved RAG Context for query '{rag_query}'")
-
-    # --- Step 3: "Building the Profile" (The Rich Prompt Synthesis) ---
-    target_language = get_language_name(language_code)
-    print(f"   -> Target language for response: {target_language}")
+    with metrics.timed("retrieval"):
+        hits = retrieve_chunks(rag_query, KNOWLEDGE_BASE_PATH, top_k=prompt_context.candidate_count(crop_type))
+        context = prompt_context.assemble_context(rag_query, hits, crop_type)
+    metrics.PROMPT_TOKENS.observe(context.tokens, "context")
+    metrics.annotate("context_tokens", context.tokens)
+    print(
+        f"   -> Assembled {len(context.passages)} passages, {context.tokens}/{context.budget} tokens "
+        f"(skipped {context.dropped['off_crop']} off-crop, {context.dropped['duplicate']} duplicate, "
+        f"{context.dropped['over_budget']} over budget)"
+    )
+    return context.text
 
-    prompt = f"""
+# --- Master Prompt ---
+# Parsed once at import; build_prompt only fills in the case details.
+_PROMPT_TEMPLATE = """
     You are an expert agronomist specializing in Kodagu (Coorg) coffee and pepper plantations. Your analysis must be scientific, practical, and easy for a local farmer to understand.
 
     **Case File:**
-    - **Farmer's Observation:** "{user_query if user_query else 'No voice note provided.'}"
+    - **Farmer's Observation:** "{user_query}"
     - **Farm History & Details:** {farm_history}
     - **Relevant Local Knowledge (from official guides):**
       ---
-      {local_context if local_context else 'No specific local context found. Rely on your general knowledge.'}
+      {local_context}
       ---
 
     **Your Task:**
@@ -79,24 +143,326 @@ def run_analysis_agent(image_base64: str, user_query: str, farm_details: dict, l
         ]
     }}
     """
-    print("   -> Master prompt for Gemini has been constructed.")
 
-    # --- Step 4: "Consulting the Expert" (Calling Gemini Vision) ---
+
+# --- The "Detective" Agent (Updated) ---
+def build_prompt(user_query: str, farm_details: dict, language_code: str, local_context: Optional[str] = None) -> str:
+    """
+    Gathers the farm history and hyper-local context and synthesises the master
+    prompt for Gemini. Pass `local_context` to reuse RAG context that was
+    already retrieved for this query.
+    """
+    print("🕵️ Agent Activated: Starting investigation...")
+
+    # --- Step 1: "Checking the Records" (Fetching Farm History) ---
+    farm_history = f"This farm is located in {farm_details.get('location', 'Kodagu')} and primarily grows {farm_details.get('crop_type', 'Robusta Coffee')}. Past issues are not yet recorded."
+    print(f"   -> Fetched Farm History: {farm_history}")
+
+    # --- Step 2: "Surveying the Scene" (Retrieving Hyper-Local Context with RAG) ---
+    if local_context is None:
+        local_context = retrieve_local_context(user_query, farm_details.get('crop_type'))
+        print(f"   -> Retrieved RAG Context for query '{user_query}'")
+
+    # --- Step 3: "Building the Profile" (The Rich Prompt Synthesis) ---
+    target_language = get_language_name(language_code)
+    print(f"   -> Target language for response: {target_language}")
+
+    prompt = _PROMPT_TEMPLATE.format(
+        user_query=user_query if user_query else 'No voice note provided.',
+        farm_history=farm_history,
+        local_context=local_context if local_context else 'No specific local context found. Rely on your general knowledge.',
+        target_language=target_language,
+    )
+    prompt_tokens = prompt_context.estimate_tokens(prompt)
+    metrics.PROMPT_TOKENS.observe(prompt_tokens, "prompt")
+    metrics.annotate("prompt_tokens", prompt_tokens)
+    print(f"   -> Master prompt for Gemini has been constructed (~{prompt_tokens} tokens).")
+    return prompt
+
+
+def parse_model_response(response_text: str) -> dict:
+    """Strips any markdown fences from Gemini's reply and parses the JSON object."""
+    response_text = response_text.strip().replace("```json", "").replace("```", "")
+    return json.loads(response_text)
+
+
+def generate_analysis_text(prompt: str, image_data: bytes, mime_type: str = "image/jpeg", timeout: Optional[float] = None) -> str:
+    """One Gemini Vision call; returns the raw reply text and raises on API errors."""
+    img = {"mime_type": mime_type, "data": image_data}
+    kwargs = {"request_options": {"timeout": timeout}} if timeout else {}
+    print("   -> Calling Gemini Vision API...")
+    with metrics.timed("model_call"):
+        return get_model().generate_content([prompt, img], **kwargs).text
+
+
+def _parse_analysis(response_text: str, mode: str) -> dict:
     try:
-        image_data = base64.b64decode(image_base64.split(',')[1])
-        img = Image.open(io.BytesIO(image_data))
-
-        # Using the model name from your previous code
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        print("   -> Calling Gemini Vision API...")
-        response = model.generate_content([prompt, img])
-        
-        response_text = response.text.strip().replace("```json", "").replace("```", "")
-        
-        import json
-        return json.loads(response_text)
+        with metrics.timed("parse"):
+            return parse_model_response(response_text)
+    except ValueError as e:
+        metrics.PARSE_FAILURES.inc(mode)
+        print(f"   -> ERROR parsing Gemini's reply: {e}")
+        return {"error": "Failed to get analysis from AI. Please try again."}
+
+
+def run_analysis_agent(
+    image_data: bytes,
+    user_query: str,
+    farm_details: dict,
+    language_code: str,
+    mime_type: str = "image/jpeg",
+    local_context: Optional[str] = None,
+) -> dict:
+    """
+    This is the core agentic function. It gathers context and uses Gemini Vision
+    to perform an expert-level analysis in the requested language.
+    `image_data` is the already downscaled and re-encoded photo (see imaging.prepare_image).
+    Makes a single attempt; the API goes through run_analysis_agent_async,
+    which adds retries and the circuit breaker.
+    """
+    prompt = build_prompt(user_query, farm_details, language_code, local_context)
 
+    # --- Step 4: "Consulting the Expert" (Calling Gemini Vision) ---
+    try:
+        response_text = generate_analysis_text(prompt, image_data, mime_type)
     except Exception as e:
+        metrics.MODEL_ERRORS.inc("sync")
         print(f"   -> ERROR during Gemini API call: {e}")
-        return {"error": "Failed to get analysis from AI. Please try again."}
\ No newline at end of file
+        return {"error": "Failed to get analysis from AI. Please try again."}
+
+    return _parse_analysis(response_text, "sync")
+
+
+def rag_only_result(user_query: str, local_context: Optional[str] = None, crop_type: Optional[str] = None) -> dict:
+    """
+    Guidance built from the knowledge base alone, in the shape of an analysis
+    result, for when Gemini is unavailable. The photo is not diagnosed and the
+    text stays in the guides' language (English).
+    """
+    if local_context is None:
+        local_context = retrieve_local_context(user_query, crop_type)
+    guidance = [para.strip() for para in (local_context or "").split(prompt_context.SEPARATOR) if para.strip()]
+    return {
+        "diseaseName": "Unconfirmed",
+        "severity": "Unknown",
+        "summary": (
+            "The AI diagnosis service is temporarily unavailable, so this photo could not be diagnosed. "
+            "The guidance below comes from the local crop guides that best match your observation."
+        ),
+        "recommendedActions": guidance or ["Please send the photo again in a few minutes for a full diagnosis."],
+        "scientificReason": "",
+        "preventativeMeasures": [],
+        "source": "knowledge_base",
+    }
+
+
+def local_diagnosis_result(disease_name: str, crop_type: Optional[str] = None) -> dict:
+    """
+    The answer for a photo the local classifier recognised with confidence:
+    its diagnosis plus the crop guides' advice for that disease. Nothing in it
+    is specific to this photo, so severity is left unassessed.
+    """
+    local_context = retrieve_local_context(disease_name, crop_type)
+    guidance = [para.strip() for para in (local_context or "").split(prompt_context.SEPARATOR) if para.strip()]
+    return {
+        "diseaseName": disease_name,
+        "severity": "Not assessed",
+        "summary": (
+            f"This photo closely matches photos confirmed as {disease_name}. "
+            "The guidance below comes from the local crop guides; send the photo again for a full AI diagnosis if unsure."
+        ),
+        "recommendedActions": guidance or [f"Follow the local crop guides' advice for {disease_name}."],
+        "scientificReason": "",
+        "preventativeMeasures": [],
+        "source": "local_classifier",
+    }
+
+
+def stream_analysis_agent(
+    image_data: bytes,
+    user_query: str,
+    farm_details: dict,
+    language_code: str,
+    mime_type: str = "image/jpeg",
+    local_context: Optional[str] = None,
+) -> Iterator[str]:
+    """Like run_analysis_agent, but yields Gemini's raw text as it is generated."""
+    prompt = build_prompt(user_query, farm_details, language_code, local_context)
+    img = {"mime_type": mime_type, "data": image_data}
+
+    print("   -> Streaming from Gemini Vision API...")
+    kwargs = {"request_options": {"timeout": resilience.MODEL_DEADLINE}} if resilience.MODEL_DEADLINE else {}
+    for chunk in get_model().generate_content([prompt, img], stream=True, **kwargs):
+        if chunk.text:
+            yield chunk.text
+
+
+class StreamingResultParser:
+    """
+    Incrementally parses Gemini's streamed JSON reply. Each call to feed()
+    returns the top-level fields whose values became complete with that chunk,
+    so the diagnosis can be shown long before the whole object has arrived.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self._pos = None  # Where the next key/value pair starts, once the '{' is seen
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, chunk: str) -> dict:
+        self.text += chunk
+        if self._pos is None:
+            start = self.text.find("{")
+            if start == -1:
+                return {}
+            self._pos = start + 1
+
+        new_fields = {}
+        while True:
+            pos = self._skip(self._pos, " \t\r\n,")
+            try:
+                key, pos = self._decoder.raw_decode(self.text, pos)
+                pos = self._skip(pos, " \t\r\n")
+                if not isinstance(key, str) or self.text[pos:pos + 1] != ":":
+                    break
+                value, pos = self._decoder.raw_decode(self.text, self._skip(pos + 1, " \t\r\n"))
+            except (json.JSONDecodeError, IndexError):
+                break  # The next value hasn't fully arrived yet
+            # A number at the very end of the buffer may still be growing
+            if pos >= len(self.text) and not isinstance(value, (str, list, dict)):
+                break
+            self.fields[key] = value
+            new_fields[key] = value
+            self._pos = pos
+        return new_fields
+
+    def result(self) -> dict:
+        """Parses the complete reply once the stream has finished."""
+        return parse_model_response(self.text)
+
+    def _skip(self, pos: int, chars: str) -> int:
+        while pos < len(self.text) and self.text[pos] in chars:
+            pos += 1
+        return pos
+
+
+async def _acquire_model_slot(queue_timeout: Optional[float]):
+    try:
+        await asyncio.wait_for(_model_slots.acquire(), timeout=queue_timeout)
+    except asyncio.TimeoutError:
+        metrics.MODEL_REJECTIONS.inc()
+        raise AgentBusyError()
+
+
+async def run_analysis_agent_async(
+    image_data: bytes,
+    user_query: str,
+    farm_details: dict,
+    language_code: str,
+    mime_type: str = "image/jpeg",
+    local_context: Optional[str] = None,
+    queue_timeout: Optional[float] = MODEL_QUEUE_TIMEOUT,
+    deadline: float = resilience.MODEL_DEADLINE,
+) -> dict:
+    """
+    Runs the agent on the model thread pool so the event loop stays free while
+    Gemini is called. Transient Gemini errors are retried with backoff within
+    `deadline` seconds; the model slot is given back between attempts.
+    Raises AgentBusyError when no model slot frees up within queue_timeout
+    seconds (None waits as long as it takes), and resilience.CircuitOpenError
+    without calling Gemini while the circuit breaker is open.
+    """
+    loop = asyncio.get_running_loop()
+    prompt = await loop.run_in_executor(
+        None,
+        contextvars.copy_context().run,
+        functools.partial(build_prompt, user_query, farm_details, language_code, local_context),
+    )
+
+    async def attempt(seconds_left: float) -> str:
+        await _acquire_model_slot(queue_timeout)
+        try:
+            resilience.breaker.before_call()
+            try:
+                # Run in a copy of our context so the stages timed in the thread count towards this request
+                text = await loop.run_in_executor(
+                    _model_executor,
+                    contextvars.copy_context().run,
+                    functools.partial(generate_analysis_text, prompt, image_data, mime_type, seconds_left),
+                )
+            except Exception as e:
+                resilience.breaker.record_failure()
+                metrics.MODEL_ERRORS.inc("sync")
+                print(f"   -> ERROR during Gemini API call: {e}")
+                raise
+            resilience.breaker.record_success()
+            return text
+        finally:
+            _model_slots.release()
+
+    try:
+        response_text = await resilience.retry_with_backoff(
+            attempt, deadline, give_up_on=(AgentBusyError, resilience.CircuitOpenError)
+        )
+    except (AgentBusyError, resilience.CircuitOpenError):
+        raise
+    except Exception:
+        return {"error": "Failed to get analysis from AI. Please try again."}
+
+    return _parse_analysis(response_text, "sync")
+
+
+async def stream_analysis_agent_async(
+    image_data: bytes,
+    user_query: str,
+    farm_details: dict,
+    language_code: str,
+    mime_type: str = "image/jpeg",
+    local_context: Optional[str] = None,
+    queue_timeout: Optional[float] = MODEL_QUEUE_TIMEOUT,
+) -> AsyncIterator[str]:
+    """
+    Takes a model slot (raising AgentBusyError or CircuitOpenError like
+    run_analysis_agent_async) and starts streaming on the model thread pool.
+    Returns an async iterator over the text chunks; errors from Gemini are
+    raised from the iterator. Streams are not retried, since part of the
+    reply may already have reached the client.
+    """
+    await _acquire_model_slot(queue_timeout)
+    try:
+        resilience.breaker.before_call()
+    except resilience.CircuitOpenError:
+        _model_slots.release()
+        raise
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    done = object()
+
+    def produce():
+        # The slot is held until Gemini is finished, even if the client goes away
+        try:
+            for text in stream_analysis_agent(image_data, user_query, farm_details, language_code, mime_type, local_context):
+                loop.call_soon_threadsafe(chunks.put_nowait, text)
+            resilience.breaker.record_success()
+        except Exception as e:
+            resilience.breaker.record_failure()
+            metrics.MODEL_ERRORS.inc("stream")
+            print(f"   -> ERROR during Gemini streaming call: {e}")
+            loop.call_soon_threadsafe(chunks.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, done)
+            loop.call_soon_threadsafe(_model_slots.release)
+
+    loop.run_in_executor(_model_executor, produce)
+
+    async def iterate():
+        while True:
+            item = await chunks.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    return iterate()
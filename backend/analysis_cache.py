@@ -0,0 +1,149 @@
+# backend/analysis_cache.py
+
+import os
+import io
+import re
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Optional
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+import crud
+
+load_dotenv()
+
+# --- Cache Settings ---
+CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "1") == "1"
+CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL", "86400"))
+# Key on a perceptual hash so re-encoded/resized copies of a photo also hit
+CACHE_PERCEPTUAL = os.getenv("ANALYSIS_CACHE_PERCEPTUAL", "0") == "1"
+# Expired rows are deleted by the first store after this many seconds
+CACHE_PURGE_INTERVAL = float(os.getenv("ANALYSIS_CACHE_PURGE_INTERVAL", "3600"))
+
+
+def _normalize_text(text: Optional[str]) -> str:
+    return " ".join(re.findall(r'\w+', (text or "").lower()))
+
+
+def image_fingerprint(image_data: bytes) -> str:
+    """
+    Returns the content hash of the decoded image bytes, or a 64-bit difference
+    hash of the pixels when perceptual keys are enabled.
+    """
+    if not CACHE_PERCEPTUAL:
+        return hashlib.sha256(image_data).hexdigest()
+
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_data)).convert("L").resize((9, 8))
+    pixels = list(img.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"dhash:{bits:016x}"
+
+
+def make_cache_key(image_data: bytes, user_query: str, crop_type: str, language_code: str) -> str:
+    """Builds the cache key from the image hash, normalized query, crop and language."""
+    parts = [
+        image_fingerprint(image_data),
+        _normalize_text(user_query),
+        _normalize_text(crop_type),
+        (language_code or "").lower(),
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """
+    Two-tier cache of successful analysis results: an in-process LRU with TTL
+    in front of the analysis_cache table, which survives restarts and is shared
+    by every worker.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: int = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, result, latency_ms)
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0, "purged": 0, "latency_saved_ms": 0.0}
+        self._last_purge = time.monotonic()
+
+    def get(self, db: Session, key: str) -> Optional[dict]:
+        """Returns the cached result for the key, checking memory first and then the database."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self._record_hit("memory_hits", entry[2])
+                return entry[1]
+            if entry:
+                del self._entries[key]
+
+        db_entry = crud.get_cached_analysis(db, key=key, max_age_seconds=self.ttl_seconds)
+        if db_entry is None:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+
+        age_seconds = (datetime.datetime.utcnow() - db_entry.created_at).total_seconds()
+        expires_at = now + self.ttl_seconds - age_seconds
+        with self._lock:
+            self._remember(key, expires_at, db_entry.result, db_entry.latency_ms or 0.0)
+            self._record_hit("db_hits", db_entry.latency_ms or 0.0)
+        return db_entry.result
+
+    def put(self, db: Session, key: str, result: dict, latency_ms: float):
+        """Stores a successful result in both tiers."""
+        with self._lock:
+            self._remember(key, time.time() + self.ttl_seconds, result, latency_ms)
+            self._stats["stores"] += 1
+        crud.save_cached_analysis(db, key=key, result=result, latency_ms=latency_ms)
+        if self._purge_due():
+            try:
+                purged = crud.purge_expired_cache(db, max_age_seconds=self.ttl_seconds)
+            except Exception as e:
+                db.rollback()
+                print(f"   -> ERROR purging the analysis cache: {e}")
+                return
+            with self._lock:
+                self._stats["purged"] += purged
+
+    def _purge_due(self) -> bool:
+        # Claimed under the lock so only one store per interval runs the DELETE
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_purge < CACHE_PURGE_INTERVAL:
+                return False
+            self._last_purge = now
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["db_hits"]) / lookups, 4) if lookups else 0.0
+        stats["latency_saved_ms"] = round(stats["latency_saved_ms"], 1)
+        return stats
+
+    def _remember(self, key: str, expires_at: float, result: dict, latency_ms: float):
+        self._entries[key] = (expires_at, result, latency_ms)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _record_hit(self, tier: str, latency_ms: float):
+        self._stats[tier] += 1
+        self._stats["latency_saved_ms"] += latency_ms
+
+
+cache = AnalysisCache()
@@ -0,0 +1,80 @@
+# backend/benchmarks/fake_model.py
+"""
+A local stand-in for genai.GenerativeModel, so benchmarks exercise the whole
+analysis path without network calls or API spend:
+
+    import agent
+    agent.set_model(FakeGeminiModel(latency=0.8, error_rate=0.02))
+"""
+
+import json
+import time
+import random
+import threading
+
+DEFAULT_RESULT = {
+    "diseaseName": "Coffee Leaf Rust",
+    "severity": "Medium",
+    "summary": "Orange powdery spots on the underside of the leaves show an active leaf rust infection.",
+    "recommendedActions": [
+        "1. Remove and destroy badly affected leaves.",
+        "2. Spray 0.5% Bordeaux mixture on the lower leaf surface.",
+    ],
+    "scientificReason": "Leaf rust is caused by the fungus Hemileia vastatrix, which spreads in humid weather.",
+    "preventativeMeasures": [
+        "Regulate shade to improve air circulation.",
+        "Plan pre- and post-monsoon prophylactic sprays.",
+    ],
+}
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """
+    Implements the generate_content([prompt, image], stream=False) surface
+    agent.py uses. Each call sleeps for about `latency` seconds (normally
+    distributed with `jitter` as relative spread) and raises with probability
+    `error_rate`. Streaming calls spread the same delay over `stream_chunks` chunks.
+    """
+
+    def __init__(self, latency: float = 0.8, jitter: float = 0.2, error_rate: float = 0.0,
+                 stream_chunks: int = 12, seed: int = None, result: dict = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stream_chunks = stream_chunks
+        self.result = result or DEFAULT_RESULT
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self._random.gauss(self.latency, self.jitter * self.latency))
+            failed = self._random.random() < self.error_rate
+            self.errors += failed
+        return delay, failed
+
+    def generate_content(self, contents, stream: bool = False, **kwargs):
+        delay, failed = self._draw()
+        text = json.dumps(self.result)
+        if not stream:
+            time.sleep(delay)
+            if failed:
+                raise RuntimeError("Simulated Gemini failure")
+            return FakeResponse(text)
+        return self._stream(text, delay, failed)
+
+    def _stream(self, text: str, delay: float, failed: bool):
+        size = max(1, -(-len(text) // self.stream_chunks))
+        for start in range(0, len(text), size):
+            time.sleep(delay / self.stream_chunks)
+            if failed and start >= len(text) // 2:
+                raise RuntimeError("Simulated Gemini failure")
+            yield FakeResponse(text[start:start + size])
@@ -0,0 +1,95 @@
+# backend/benchmarks/harness.py
+"""
+Shared setup for the benchmarks: a throwaway environment, an in-process HTTP
+client for the FastAPI app (lifespan included) and latency summaries.
+"""
+
+import os
+import sys
+import platform
+import tempfile
+import subprocess
+from contextlib import asynccontextmanager
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def configure_environment(**overrides):
+    """
+    Points the app at a fresh SQLite database and blob folder and fills in
+    the settings it needs. Must run before any app module is imported, since
+    they read their settings at import time. The database and blob folder are
+    always the throwaway ones, so an exported DATABASE_URL is never written
+    to; for the other settings, values already in the environment win over
+    the defaults, and `overrides` win over both.
+    """
+    run_dir = tempfile.mkdtemp(prefix="ceres-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(run_dir, 'bench.db')}"
+    os.environ["BLOB_STORE_DIR"] = os.path.join(run_dir, "blobs")
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    # The benchmarks hammer a single account from a single IP
+    os.environ.setdefault("LOGIN_ATTEMPTS_PER_IP", "1000000")
+    os.environ.setdefault("LOGIN_ATTEMPTS_PER_ACCOUNT", "1000000")
+    for key, value in overrides.items():
+        os.environ[key] = str(value)
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(BACKEND_DIR)
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def latency_summary(latencies: list) -> dict:
+    """p50/p90/p99/max of a list of durations in seconds, reported in ms."""
+    ordered = sorted(latencies)
+    return {
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(ordered, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+
+
+def environment_info() -> dict:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+@asynccontextmanager
+async def app_client():
+    """Runs the app's lifespan and yields an httpx client that calls it in-process."""
+    import httpx
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            yield client
+
+
+async def sign_up(client, email: str, password: str = "bench-pass", farm: bool = False) -> dict:
+    """Creates the user (and optionally a farm) and returns its Authorization header."""
+    await client.post("/api/v1/users/", json={"name": "Bench", "email": email, "password": password})
+    response = await client.post("/api/v1/token", data={"username": email, "password": password})
+    response.raise_for_status()
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+    if farm:
+        farm_data = {"name": "Bench Estate", "location": {"lat": 12.42, "lon": 75.74}, "crop_type": "Robusta Coffee"}
+        (await client.post("/api/v1/farms/", json=farm_data, headers=headers)).raise_for_status()
+    return headers
@@ -0,0 +1,63 @@
+# backend/benchmarks/login_benchmark.py
+"""
+Measures login throughput (logins per second) through the real /api/v1/token
+endpoint, against a throwaway SQLite database.
+
+    python benchmarks/login_benchmark.py --logins 200 --concurrency 16 --rounds 12
+
+Try PASSWORD_HASH_EXECUTOR=process and different PASSWORD_HASH_WORKERS values
+to compare executors.
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+
+from harness import app_client, configure_environment, latency_summary, sign_up
+
+
+async def run_logins(client, logins: int, concurrency: int) -> dict:
+    await sign_up(client, "bench@example.com")
+    form = {"username": "bench@example.com", "password": "bench-pass"}
+
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def login():
+        async with slots:
+            started = time.perf_counter()
+            response = await client.post("/api/v1/token", data=form)
+            latencies.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "benchmark": "login",
+        "logins": logins,
+        "concurrency": concurrency,
+        "bcrypt_rounds": int(os.environ["BCRYPT_ROUNDS"]),
+        "executor": os.getenv("PASSWORD_HASH_EXECUTOR", "thread"),
+        "logins_per_second": round(logins / elapsed, 2),
+        **latency_summary(latencies),
+    }
+
+
+async def run(logins: int, concurrency: int) -> dict:
+    async with app_client() as client:
+        return await run_logins(client, logins, concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Login throughput microbenchmark")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost factor")
+    args = parser.parse_args()
+
+    configure_environment(BCRYPT_ROUNDS=args.rounds)
+    print(json.dumps(asyncio.run(run(args.logins, args.concurrency)), indent=2))
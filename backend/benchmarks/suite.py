@@ -0,0 +1,284 @@
+# backend/benchmarks/suite.py
+"""
+Runs the backend benchmarks against a throwaway SQLite database and a local
+Gemini stand-in (see fake_model.py), and prints one JSON document so runs can
+be compared across commits:
+
+    python benchmarks/suite.py --output bench.json
+    python benchmarks/suite.py --only analyze --concurrency 1,8,32 --model-latency 0.5 --error-rate 0.02
+
+Benchmarks:
+  analyze    /api/v1/analyze throughput and latency at each concurrency level
+  retrieval  retrieve_context latency (and index build time) on synthetic
+             knowledge bases of growing size
+  login      /api/v1/token throughput
+  history    /api/v1/history/me page latency as the cursor walks deeper
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+
+from harness import app_client, configure_environment, environment_info, latency_summary, sign_up
+
+BENCHMARKS = ("analyze", "retrieval", "login", "history")
+
+
+def _int_list(value: str) -> list:
+    return [int(part) for part in value.split(",") if part]
+
+
+# --- /api/v1/analyze ---
+def _photo_payloads(count: int, seed: int = 7) -> list:
+    """Distinct leaf-like JPEGs, so neither the analysis cache nor the classifier can answer for the model."""
+    import base64
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(count):
+        img = Image.new("RGB", (1280, 960), (rng.randint(20, 80), rng.randint(90, 170), rng.randint(20, 70)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x, y, r = rng.randint(0, 1280), rng.randint(0, 960), rng.randint(4, 30)
+            draw.ellipse([x, y, x + r, y + r], fill=(rng.randint(150, 255), rng.randint(60, 160), rng.randint(0, 60)))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=85)
+        payloads.append("data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode())
+    return payloads
+
+
+async def bench_analyze(client, levels: list, requests_per_level: int) -> list:
+    headers = await sign_up(client, "analyze@bench.local", farm=True)
+    photos = _photo_payloads(requests_per_level * len(levels))
+    queries = ["yellow powder under leaves", "leaves wilting quickly", "black spots on berries", ""]
+
+    results = []
+    for level_index, concurrency in enumerate(levels):
+        slots = asyncio.Semaphore(concurrency)
+        latencies, statuses = [], {}
+
+        async def analyze(i: int):
+            body = {
+                "image": photos[level_index * requests_per_level + i],
+                "userQuery": queries[i % len(queries)],
+                "location": {},
+                "languageCode": "en",
+            }
+            async with slots:
+                started = time.perf_counter()
+                response = await client.post("/api/v1/analyze", json=body, headers=headers)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(analyze(i) for i in range(requests_per_level)))
+        elapsed = time.perf_counter() - started
+        results.append({
+            "benchmark": "analyze",
+            "concurrency": concurrency,
+            "requests": requests_per_level,
+            "requests_per_second": round(requests_per_level / elapsed, 2),
+            "statuses": {str(code): count for code, count in sorted(statuses.items())},
+            **latency_summary(latencies),
+        })
+    return results
+
+
+# --- retrieve_context ---
+def _write_synthetic_kb(path: str, chunks: int, vocabulary: list, seed: int = 11):
+    """Hard-wrapped guide-like text of roughly `chunks` retrieval chunks, 200 chunks per file."""
+    import rag_tool
+
+    rng = random.Random(seed)
+    chars_per_chunk = (rag_tool.CHUNK_TARGET_CHARS + rag_tool.CHUNK_MAX_CHARS) // 2
+    for file_index in range(max(1, -(-chunks // 200))):
+        lines, size = [], 0
+        target = min(200, chunks - file_index * 200) * chars_per_chunk
+        while size < target:
+            sentence = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(8, 20))).capitalize() + "."
+            lines.append(sentence)
+            size += len(sentence) + 1
+        with open(os.path.join(path, f"guide_{file_index:04d}.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+
+
+def bench_retrieval(kb_sizes: list, queries: int, modes: list) -> list:
+    import rag_tool
+    import kb_index
+
+    vocabulary = []
+    for name in sorted(os.listdir("knowledge_base")):
+        if name.endswith(".txt"):
+            with open(os.path.join("knowledge_base", name), encoding="utf-8") as f:
+                vocabulary.extend(token for token in rag_tool.tokenize(f.read()) if token.isalpha())
+    rng = random.Random(3)
+    query_texts = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(2, 6))) for _ in range(queries)]
+
+    results = []
+    for size in kb_sizes:
+        path = tempfile.mkdtemp(prefix=f"ceres-kb-{size}-")
+        _write_synthetic_kb(path, size, vocabulary)
+
+        started = time.perf_counter()
+        kb_index.build_index(path)
+        build_seconds = time.perf_counter() - started
+
+        for mode in modes:
+            setup_started = time.perf_counter()
+            if mode == "memory":
+                index = rag_tool.KnowledgeBaseIndex(path)
+                index.refresh(force=True)
+                search = lambda q: "\n\n---\n\n".join(hit.text for hit in index.search(q))
+            else:
+                rag_tool.warm_up(path, mode=mode)
+                search = lambda q, mode=mode: rag_tool.retrieve_context(q, path, mode=mode)
+            setup_seconds = time.perf_counter() - setup_started
+
+            latencies = []
+            for query in query_texts:
+                started = time.perf_counter()
+                search(query)
+                latencies.append(time.perf_counter() - started)
+            results.append({
+                "benchmark": "retrieval",
+                "mode": mode,
+                "kb_chunks_requested": size,
+                "artifact_build_ms": round(build_seconds * 1000, 1),
+                "setup_ms": round(setup_seconds * 1000, 1),
+                "queries": len(query_texts),
+                **latency_summary(latencies),
+            })
+    return results
+
+
+# --- /api/v1/history/me ---
+async def bench_history(client, rows: int, page_size: int, depths: list) -> dict:
+    import crud
+    from database import SessionLocal
+
+    headers = await sign_up(client, "history@bench.local", farm=True)
+    me = (await client.get("/api/v1/farms/me", headers=headers)).json()[0]
+    base_time = datetime.datetime.utcnow()
+    with SessionLocal() as db:
+        batch = []
+        for i in range(rows):
+            batch.append({
+                "owner_id": me["owner_id"], "farm_id": me["id"], "user_query": f"observation {i}",
+                "timestamp": base_time - datetime.timedelta(minutes=i),
+                "offline_disease_name": "Unknown", "offline_confidence_score": 0.0,
+                "online_disease_name": "Coffee Leaf Rust", "online_severity": "Medium",
+                "online_summary": "Orange spots on the leaves.", "online_recommended_actions": ["Spray"],
+                "online_scientific_reason": "Fungus.", "online_preventative_measures": ["Shade"],
+            })
+            if len(batch) == 1000:
+                crud.insert_analysis_rows(db, batch)
+                batch = []
+        if batch:
+            crud.insert_analysis_rows(db, batch)
+
+    page_latencies, cursor, page = {}, None, 0
+    while True:
+        params = {"limit": page_size}
+        if cursor:
+            params["cursor"] = cursor
+        started = time.perf_counter()
+        response = await client.get("/api/v1/history/me", params=params, headers=headers)
+        page_latencies[page] = time.perf_counter() - started
+        response.raise_for_status()
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+        page += 1
+
+    return {
+        "benchmark": "history",
+        "rows": rows,
+        "page_size": page_size,
+        "pages": len(page_latencies),
+        "page_ms_by_depth": {
+            str(depth): round(page_latencies[depth] * 1000, 3) for depth in depths if depth in page_latencies
+        },
+        **latency_summary(list(page_latencies.values())),
+    }
+
+
+async def run(args) -> dict:
+    import agent
+    from fake_model import FakeGeminiModel
+
+    fake = FakeGeminiModel(latency=args.model_latency, jitter=args.model_jitter, error_rate=args.error_rate, seed=1)
+    agent.set_model(fake)
+
+    selected = args.only.split(",") if args.only else list(BENCHMARKS)
+    results = []
+    if "retrieval" in selected:
+        results.extend(bench_retrieval(_int_list(args.kb_sizes), args.queries, args.rag_modes.split(",")))
+    if {"analyze", "login", "history"} & set(selected):
+        async with app_client() as client:
+            if "analyze" in selected:
+                results.extend(await bench_analyze(client, _int_list(args.concurrency), args.requests))
+            if "login" in selected:
+                from login_benchmark import run_logins
+                results.append(await run_logins(client, args.logins, args.login_concurrency))
+            if "history" in selected:
+                results.append(await bench_history(client, args.history_rows, args.page_size, _int_list(args.history_depths)))
+
+    return {
+        "suite": "ceres-backend",
+        "started_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "environment": environment_info(),
+        "settings": {**vars(args), "model_calls": fake.calls, "model_errors": fake.errors},
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ceres backend benchmark suite")
+    parser.add_argument("--only", default="", help="comma-separated subset of: " + ",".join(BENCHMARKS))
+    parser.add_argument("--output", default=None, help="also write the JSON to this file")
+    # analyze
+    parser.add_argument("--concurrency", default="1,8,32", help="concurrency levels for /api/v1/analyze")
+    parser.add_argument("--requests", type=int, default=64, help="analyze requests per concurrency level")
+    parser.add_argument("--model-latency", type=float, default=0.5, help="fake Gemini latency in seconds")
+    parser.add_argument("--model-jitter", type=float, default=0.2, help="relative spread of that latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake Gemini calls that fail")
+    # retrieval
+    parser.add_argument("--kb-sizes", default="100,1000,10000", help="synthetic knowledge-base sizes, in chunks")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--rag-modes", default="keyword,memory", help="keyword, memory, semantic and/or hybrid")
+    # login
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--login-concurrency", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost factor")
+    # history
+    parser.add_argument("--history-rows", type=int, default=20000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--history-depths", default="0,10,50,100,199")
+    args = parser.parse_args()
+
+    max_concurrency = max(_int_list(args.concurrency))
+    configure_environment(
+        BCRYPT_ROUNDS=args.rounds,
+        # Measure the model path: every analyze request gets a model slot and a
+        # distinct photo, and the local classifier never answers on its own
+        MODEL_MAX_CONCURRENCY=os.getenv("MODEL_MAX_CONCURRENCY", max_concurrency),
+        MODEL_QUEUE_TIMEOUT=os.getenv("MODEL_QUEUE_TIMEOUT", 60),
+        LOCAL_CLASSIFIER_THRESHOLD=os.getenv("LOCAL_CLASSIFIER_THRESHOLD", 2),
+        LOCAL_CLASSIFIER_FALLBACK_THRESHOLD=os.getenv("LOCAL_CLASSIFIER_FALLBACK_THRESHOLD", 2),
+        MODEL_WARM_UP=0,
+    )
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+    sys.stdout.flush()
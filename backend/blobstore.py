@@ -0,0 +1,189 @@
+# backend/blobstore.py
+
+import os
+import io
+import hmac
+import hashlib
+import tempfile
+from abc import ABC, abstractmethod
+from typing import NamedTuple, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Blob Store Settings ---
+# Uploaded photos are kept on disk under the sha256 of their bytes, so a photo
+# submitted again is stored once, with a small JPEG thumbnail made when it is
+# first written. Analyses record the photo's URL; the bytes never go in the
+# database. A URL is a capability for one user: it carries the content hash,
+# the owner's id and an HMAC of both under IMAGE_URL_SECRET, so it can't be
+# derived from the photo itself, and <img> tags can load it without an
+# Authorization header.
+BLOB_STORE_ENABLED = os.getenv("BLOB_STORE_ENABLED", "1") == "1"
+BLOB_STORE_BACKEND = os.getenv("BLOB_STORE_BACKEND", "local")
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "blobs")
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+IMAGE_URL_SECRET = os.getenv("IMAGE_URL_SECRET") or os.getenv("SECRET_KEY") or ""
+
+IMAGE_URL_PREFIX = "/api/v1/images/"
+THUMBNAIL_SUFFIX = "/thumbnail"
+ORIGINAL, THUMBNAIL = "original", "thumbnail"
+
+# Leading bytes of the formats phones and browsers upload
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def sniff_content_type(header: bytes) -> str:
+    for signature, content_type in _SIGNATURES:
+        if header.startswith(signature):
+            return content_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/heic"
+    return "application/octet-stream"
+
+
+def is_valid_key(key: str) -> bool:
+    return len(key) == 64 and all(c in "0123456789abcdef" for c in key)
+
+
+def _signature(key: str, owner_id) -> str:
+    if not IMAGE_URL_SECRET:
+        raise ValueError("No IMAGE_URL_SECRET (or SECRET_KEY) set for signing image URLs")
+    message = f"{key}.{owner_id}".encode("utf-8")
+    return hmac.new(IMAGE_URL_SECRET.encode("utf-8"), message, hashlib.sha256).hexdigest()[:32]
+
+
+def image_token(key: str, owner_id: int) -> str:
+    """The signed '<key>.<owner id>.<signature>' path segment of an image URL."""
+    return f"{key}.{owner_id}.{_signature(key, owner_id)}"
+
+
+def key_from_token(token: str) -> Optional[str]:
+    """The blob key of a signed image token, or None if it is malformed or forged."""
+    parts = token.split(".")
+    if len(parts) != 3 or not is_valid_key(parts[0]) or not parts[1].isdigit():
+        return None
+    key, owner_id, signature = parts
+    return key if hmac.compare_digest(signature, _signature(key, owner_id)) else None
+
+
+def image_url(key: str, owner_id: int) -> str:
+    return IMAGE_URL_PREFIX + image_token(key, owner_id)
+
+
+def thumbnail_url(url: Optional[str]) -> Optional[str]:
+    """The thumbnail URL of a stored image's URL (None stays None)."""
+    if not url or not url.startswith(IMAGE_URL_PREFIX):
+        return None
+    return url + THUMBNAIL_SUFFIX
+
+
+def make_thumbnail(image_data: bytes) -> bytes:
+    """A JPEG no larger than THUMBNAIL_SIZE on its longest side, EXIF rotation applied."""
+    from PIL import Image, ImageOps
+
+    img = Image.open(io.BytesIO(image_data))
+    # Let the JPEG decoder downscale while decoding instead of decoding all 12 MP
+    img.draft("RGB", (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+class StoredBlob(NamedTuple):
+    path: str
+    size: int
+    modified: float  # Unix time
+    content_type: str
+
+
+class BlobStore(ABC):
+    """
+    Content-addressed image storage. Backends implement _write, _exists and
+    locate; put_image handles hashing, deduplication and thumbnails.
+    """
+
+    def put_image(self, image_data: bytes) -> str:
+        """Stores the photo and its thumbnail (once per distinct content); returns its key."""
+        key = hashlib.sha256(image_data).hexdigest()
+        if not self._exists(key, THUMBNAIL):
+            # The thumbnail goes last: once it exists, both blobs do
+            thumbnail = make_thumbnail(image_data)
+            self._write(key, ORIGINAL, image_data)
+            self._write(key, THUMBNAIL, thumbnail)
+        return key
+
+    @abstractmethod
+    def locate(self, key: str, variant: str = ORIGINAL) -> Optional[StoredBlob]:
+        """The stored blob for the key and variant, or None if it is missing."""
+
+    @abstractmethod
+    def _exists(self, key: str, variant: str) -> bool:
+        """Whether the blob is stored."""
+
+    @abstractmethod
+    def _write(self, key: str, variant: str, data: bytes):
+        """Stores the blob; readers must never see it partially written."""
+
+
+class LocalBlobStore(BlobStore):
+    """Files under <root>/<first two hex digits>/<key>[.thumb.jpg], written atomically."""
+
+    def __init__(self, root: str = BLOB_STORE_DIR):
+        self.root = root
+
+    def _path(self, key: str, variant: str) -> str:
+        name = key + ".thumb.jpg" if variant == THUMBNAIL else key
+        return os.path.join(self.root, key[:2], name)
+
+    def _exists(self, key: str, variant: str) -> bool:
+        return os.path.exists(self._path(key, variant))
+
+    def _write(self, key: str, variant: str, data: bytes):
+        path = self._path(key, variant)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def locate(self, key: str, variant: str = ORIGINAL) -> Optional[StoredBlob]:
+        if not is_valid_key(key):
+            return None
+        path = self._path(key, variant)
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if variant == THUMBNAIL:
+            content_type = "image/jpeg"
+        else:
+            with open(path, "rb") as f:
+                content_type = sniff_content_type(f.read(16))
+        return StoredBlob(path, stat_result.st_size, stat_result.st_mtime, content_type)
+
+
+def get_store() -> BlobStore:
+    if BLOB_STORE_BACKEND == "local":
+        return LocalBlobStore(BLOB_STORE_DIR)
+    raise ValueError(f"Unknown BLOB_STORE_BACKEND '{BLOB_STORE_BACKEND}'")
+
+
+store = get_store()
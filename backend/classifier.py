@@ -0,0 +1,188 @@
+# backend/classifier.py
+
+import io
+import os
+import time
+import threading
+from collections import defaultdict
+from typing import NamedTuple, Optional
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+
+import crud
+
+load_dotenv()
+
+# --- Local Classifier Settings ---
+# A k-nearest-neighbour model over colour/texture features of past photos whose
+# diagnosis was confirmed (POST /api/v1/history/{id}/confirm); Gemini's own
+# labels are never trained on. It fills the offline_* fields of every analysis
+# and, when LOCAL_CLASSIFIER_SHORT_CIRCUIT=1, answers confident cases from the
+# crop guides without calling Gemini.
+CLASSIFIER_ENABLED = os.getenv("LOCAL_CLASSIFIER_ENABLED", "1") == "1"
+SHORT_CIRCUIT_ENABLED = os.getenv("LOCAL_CLASSIFIER_SHORT_CIRCUIT", "0") == "1"
+# Answer from the guides instead of calling Gemini at or above this confidence
+SHORT_CIRCUIT_CONFIDENCE = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.9"))
+# Lower bar, only used when the Gemini call fails
+FALLBACK_CONFIDENCE = float(os.getenv("LOCAL_CLASSIFIER_FALLBACK_THRESHOLD", "0.5"))
+NEIGHBOURS = int(os.getenv("LOCAL_CLASSIFIER_K", "7"))
+MIN_SAMPLES = int(os.getenv("LOCAL_CLASSIFIER_MIN_SAMPLES", "30"))
+MAX_SAMPLES = int(os.getenv("LOCAL_CLASSIFIER_MAX_SAMPLES", "20000"))
+REFRESH_INTERVAL = float(os.getenv("LOCAL_CLASSIFIER_REFRESH_INTERVAL", "300"))
+
+FEATURE_SIZE = 128  # Photos are reduced to at most this many pixels per side
+HUE_BINS, SATURATION_BINS, VALUE_BINS, EDGE_BINS = 12, 4, 4, 8
+FEATURE_DIM = HUE_BINS * SATURATION_BINS + VALUE_BINS + EDGE_BINS
+# Neighbours further away than this percentile of same-label nearest-neighbour
+# distances don't vote, so photos unlike anything seen before stay "Unknown"
+RADIUS_PERCENTILE = 90
+UNKNOWN = "Unknown"
+
+
+class Prediction(NamedTuple):
+    disease_name: str
+    confidence: float
+    features: Optional[bytes] = None  # Set only when the photo should become a training sample
+    served_locally: bool = False
+
+
+NO_PREDICTION = Prediction(UNKNOWN, 0.0)
+
+
+def extract_features(image_data: bytes) -> bytes:
+    """
+    Describes the photo by its hue x saturation and brightness histograms
+    (colour) and a histogram of edge strengths (texture), as float32 bytes.
+    Raises if the image can't be decoded.
+    """
+    import numpy as np
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(image_data))
+    img.draft("RGB", (FEATURE_SIZE, FEATURE_SIZE))
+    img = img.convert("RGB")
+    img.thumbnail((FEATURE_SIZE, FEATURE_SIZE))
+
+    hsv = np.asarray(img.convert("HSV"), dtype=np.float32).reshape(-1, 3) / 255.0
+    colour = np.histogram2d(hsv[:, 0], hsv[:, 1], bins=(HUE_BINS, SATURATION_BINS), range=((0, 1), (0, 1)))[0].ravel()
+    brightness = np.histogram(hsv[:, 2], bins=VALUE_BINS, range=(0, 1))[0]
+
+    gray = np.asarray(img.convert("L"), dtype=np.float32) / 255.0
+    gradient = np.hypot(np.diff(gray, axis=1)[:-1, :], np.diff(gray, axis=0)[:, :-1])
+    edges = np.histogram(np.minimum(gradient, 0.5), bins=EDGE_BINS, range=(0, 0.5))[0]
+
+    # Each block is normalised, then square-rooted (Hellinger) so small patches
+    # such as orange rust pustules still count next to a mostly green leaf
+    blocks = [np.sqrt(block / max(block.sum(), 1)) for block in (colour, brightness, edges)]
+    return np.concatenate(blocks).astype(np.float32).tobytes()
+
+
+class LocalClassifier:
+    """
+    Holds the training samples in memory and reloads them from the analysis
+    history every REFRESH_INTERVAL seconds, and right away when a diagnosis
+    is confirmed through this worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._labels = []       # disease name of each sample
+        self._matrix = None     # float32 feature vectors, one row per sample
+        self._radius = 0.0
+        self._radius_samples = 0  # Sample count when the radius was last computed
+        self._last_refresh = 0.0
+
+    @property
+    def sample_count(self) -> int:
+        return len(self._labels)
+
+    def refresh_due(self) -> bool:
+        """True (once per REFRESH_INTERVAL, for the first caller) when the samples should be reloaded."""
+        with self._lock:
+            now = time.monotonic()
+            if self._last_refresh and now - self._last_refresh < REFRESH_INTERVAL:
+                return False
+            self._last_refresh = now
+            return True
+
+    def load_samples(self, rows: list):
+        """
+        Replaces the samples with crud.get_classifier_samples rows. The numpy
+        work runs here, outside the lock and off the event loop (call it
+        through run_in_threadpool); the radius is only recomputed once the
+        sample count has doubled or halved since it was last computed.
+        """
+        import numpy as np
+
+        vectors, labels = [], []
+        for features, disease_name in rows:
+            vector = np.frombuffer(features, dtype=np.float32)
+            if vector.shape[0] == FEATURE_DIM:
+                vectors.append(vector)
+                labels.append(disease_name.strip())
+        matrix = np.stack(vectors) if vectors else None
+
+        radius, radius_samples = self._radius, self._radius_samples
+        if matrix is not None and not (radius_samples / 2 < len(labels) < 2 * radius_samples):
+            radius, radius_samples = self._compute_radius(matrix, labels), len(labels)
+        with self._lock:
+            self._matrix, self._labels = matrix, labels
+            self._radius, self._radius_samples = radius, radius_samples
+
+    def refresh(self, db: Session, force: bool = False):
+        """Reloads the samples if they are due (or force) within a sync request."""
+        if force or self.refresh_due():
+            self.load_samples(crud.get_classifier_samples(db, MAX_SAMPLES))
+
+    @staticmethod
+    def _compute_radius(matrix, labels: list) -> float:
+        # Each probed sample's distance to its nearest other sample with the
+        # same label; probing a subsample bounds the work
+        import numpy as np
+
+        labels = np.array(labels)
+        probe = np.random.default_rng(0).choice(len(matrix), size=min(len(matrix), 1000), replace=False)
+        squared = (matrix ** 2).sum(axis=1)
+        distances = np.sqrt(np.maximum(squared[probe][:, None] - 2 * matrix[probe] @ matrix.T + squared[None, :], 0))
+        distances[np.arange(len(probe)), probe] = np.inf
+        distances[labels[probe][:, None] != labels[None, :]] = np.inf
+        nearest = distances.min(axis=1)
+        nearest = nearest[np.isfinite(nearest)]
+        return float(np.percentile(nearest, RADIUS_PERCENTILE)) if len(nearest) else 0.0
+
+    def predict(self, features: bytes) -> Prediction:
+        import numpy as np
+
+        with self._lock:
+            if len(self._labels) < MIN_SAMPLES:
+                return Prediction(UNKNOWN, 0.0, features)
+            matrix, labels, radius = self._matrix, self._labels, self._radius
+
+        vector = np.frombuffer(features, dtype=np.float32)
+        distances = np.sqrt(((matrix - vector) ** 2).sum(axis=1))
+        k = min(NEIGHBOURS, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        weights = 1.0 / (distances[nearest] + 1e-6)
+
+        votes = defaultdict(float)
+        for index, weight in zip(nearest, weights):
+            if distances[index] <= radius:
+                votes[labels[index]] += weight
+        if not votes:
+            return Prediction(UNKNOWN, 0.0, features)
+        best = max(votes, key=votes.get)
+        # Neighbours outside the radius count against the winner
+        return Prediction(best, round(float(votes[best] / weights.sum()), 4), features)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": CLASSIFIER_ENABLED,
+            "samples": len(self._labels),
+            "labels": len(set(self._labels)),
+            "radius": round(self._radius, 4),
+            "short_circuit_enabled": SHORT_CIRCUIT_ENABLED,
+            "short_circuit_confidence": SHORT_CIRCUIT_CONFIDENCE,
+        }
+
+
+model = LocalClassifier()
@@ -1,9 +1,16 @@
 # backend/crud.py
 
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, or_, insert, select, func, bindparam, Date, Integer, String
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, undefer
+from sqlalchemy.exc import IntegrityError
+from collections import Counter
 import models, schemas
 import security
+import geo
 import json
+import datetime
+from typing import Optional
 
 # --- Users ---
 def get_user_by_email(db: Session, email: str):
@@ -11,7 +18,8 @@ def get_user_by_email(db: Session, email: str):
 
 
 def create_user(db: Session, user_data: dict):
-    hashed_password = security.get_password_hash(user_data['password'])
+    # Callers on the event loop hash the password off-thread and pass it in
+    hashed_password = user_data.get('hashed_password') or security.get_password_hash(user_data['password'])
     db_user = models.User(
         email=user_data['email'],
         name=user_data['name'],
@@ -20,6 +28,18 @@ def create_user(db: Session, user_data: dict):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    security.invalidate_cached_user(db_user.email)
+    return db_user
+
+
+def update_user(db: Session, db_user: models.User, updates: dict):
+    old_email = db_user.email
+    for field, value in updates.items():
+        setattr(db_user, field, value)
+    db.commit()
+    db.refresh(db_user)
+    security.invalidate_cached_user(old_email)
+    security.invalidate_cached_user(db_user.email)
     return db_user
 
 
@@ -30,7 +50,8 @@ def create_user_farm(db: Session, farm: schemas.FarmCreate, user_id: int):
     name=farm.name,
     location=farm.location.dict(),  # ✅ Pydantic Location -> dict
     crop_type=farm.crop_type,
-    owner_id=user_id
+    owner_id=user_id,
+    **geo.location_columns(farm.location)
 )
 
     db.add(db_farm)
@@ -42,11 +63,40 @@ def create_user_farm(db: Session, farm: schemas.FarmCreate, user_id: int):
 def get_farms_by_user(db: Session, user_id: int):
     return db.query(models.Farm).filter(models.Farm.owner_id == user_id).all()
 
+
+def farm_payload(farm) -> dict:
+    """The schemas.Farm shape of a Farm row, from its typed coordinates when it has them."""
+    if farm.latitude is not None and farm.longitude is not None:
+        location = {"lat": farm.latitude, "lon": farm.longitude}
+    else:
+        location = json.loads(farm.location) if isinstance(farm.location, str) else farm.location
+    return {
+        "name": farm.name,
+        "location": {"lat": location["lat"], "lon": location["lon"]},
+        "crop_type": farm.crop_type,
+        "id": farm.id,
+        "owner_id": farm.owner_id,
+    }
+
+
+def get_farm_rows(db: Session, user_id: int):
+    """A user's farms as schemas.Farm dicts, plus when the newest of them changed."""
+    farm = models.Farm
+    rows = (
+        db.query(farm.id, farm.name, farm.location, farm.crop_type, farm.owner_id, farm.latitude, farm.longitude, farm.updated_at)
+        .filter(farm.owner_id == user_id)
+        .order_by(farm.id)
+        .all()
+    )
+    last_modified = max((row.updated_at for row in rows if row.updated_at), default=None)
+    return [farm_payload(row) for row in rows], last_modified
+
 def get_farm_by_owner(db: Session, owner_id: int):
     return db.query(models.Farm).filter(models.Farm.owner_id == owner_id).first()
 
 
 # --- Analysis Results ---
+# Every write path also bumps the outbreak rollups, in the same transaction.
 def create_analysis_result(db: Session, result: schemas.AnalysisResultCreate, user_id: int, farm_id: int):
     db_result = models.AnalysisResult(
         **result.model_dump(),  # Convert Pydantic model to dict
@@ -54,11 +104,65 @@ def create_analysis_result(db: Session, result: schemas.AnalysisResultCreate, us
         farm_id=farm_id
     )
     db.add(db_result)
+    record_outbreak_counts(db, [(farm_id, result.online_disease_name, None)])
     db.commit()
     db.refresh(db_result)
     return db_result
 
 
+def create_analysis_results(db: Session, results: list, user_id: int, farm_id: int):
+    """Saves several analyses in one transaction; rows aren't refreshed afterwards."""
+    db_results = [
+        models.AnalysisResult(**result.model_dump(), owner_id=user_id, farm_id=farm_id)
+        for result in results
+    ]
+    db.add_all(db_results)
+    record_outbreak_counts(db, [(farm_id, result.online_disease_name, None) for result in results])
+    db.commit()
+    return db_results
+
+
+def insert_analysis_rows(db: Session, rows: list):
+    """Multi-row INSERT of plain AnalysisResult column dicts, used by the write-behind flusher."""
+    db.execute(insert(models.AnalysisResult), rows)
+    record_outbreak_counts(
+        db, [(row.get("farm_id"), row.get("online_disease_name"), row.get("timestamp")) for row in rows]
+    )
+    db.commit()
+
+
+def get_classifier_samples(db: Session, limit: int):
+    """(image_features, confirmed_disease_name) of the newest analyses with a confirmed diagnosis."""
+    return (
+        db.query(models.AnalysisResult.image_features, models.AnalysisResult.confirmed_disease_name)
+        .filter(
+            models.AnalysisResult.image_features.isnot(None),
+            models.AnalysisResult.confirmed_disease_name.isnot(None),
+        )
+        .order_by(models.AnalysisResult.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def confirm_analysis(db: Session, analysis_id: int, user_id: int, disease_name: Optional[str] = None):
+    """
+    Records the confirmed diagnosis of one of the user's analyses (Gemini's, unless
+    corrected). Returns (row, image features), or None if the user has no such analysis.
+    """
+    db_result = (
+        db.query(models.AnalysisResult)
+        .options(undefer(models.AnalysisResult.image_features))
+        .filter(models.AnalysisResult.id == analysis_id, models.AnalysisResult.owner_id == user_id)
+        .first()
+    )
+    if db_result is None:
+        return None
+    db_result.confirmed_disease_name = " ".join((disease_name or db_result.online_disease_name or "").split()) or None
+    db.commit()
+    return db_result, db_result.image_features
+
+
 def get_analysis_history_for_user(db: Session, user_id: int, skip: int = 0, limit: int = 100):
     return (
         db.query(models.AnalysisResult)
@@ -68,3 +172,230 @@ def get_analysis_history_for_user(db: Session, user_id: int, skip: int = 0, limi
         .limit(limit)
         .all()
     )
+
+
+# Columns read by history list views; the large JSON columns are left out
+ANALYSIS_SUMMARY_COLUMNS = (
+    models.AnalysisResult.id,
+    models.AnalysisResult.timestamp,
+    models.AnalysisResult.image_url,
+    models.AnalysisResult.user_query,
+    models.AnalysisResult.offline_disease_name,
+    models.AnalysisResult.offline_confidence_score,
+    models.AnalysisResult.online_disease_name,
+    models.AnalysisResult.online_severity,
+    models.AnalysisResult.online_summary,
+    models.AnalysisResult.owner_id,
+    models.AnalysisResult.farm_id,
+)
+
+
+# The schemas.AnalysisResult fields, read as plain rows for the history endpoint
+ANALYSIS_HISTORY_COLUMNS = ANALYSIS_SUMMARY_COLUMNS + (
+    models.AnalysisResult.online_recommended_actions,
+    models.AnalysisResult.online_scientific_reason,
+    models.AnalysisResult.online_preventative_measures,
+)
+
+
+def get_analysis_history_page(
+    db: Session,
+    user_id: int,
+    limit: int = 20,
+    before: tuple = None,
+    summary: bool = False
+):
+    """
+    Keyset pagination over a user's history, newest first. `before` is the
+    (timestamp, id) of the last row of the previous page. Returns the page as
+    plain dicts, ready to serialize, and the (timestamp, id) cursor of the next
+    page, or None on the last page.
+    """
+    columns = ANALYSIS_SUMMARY_COLUMNS if summary else ANALYSIS_HISTORY_COLUMNS
+    query = db.query(*columns).filter(models.AnalysisResult.owner_id == user_id)
+    if before is not None:
+        before_timestamp, before_id = before
+        query = query.filter(or_(
+            models.AnalysisResult.timestamp < before_timestamp,
+            and_(models.AnalysisResult.timestamp == before_timestamp, models.AnalysisResult.id < before_id)
+        ))
+
+    rows = (
+        query.order_by(models.AnalysisResult.timestamp.desc(), models.AnalysisResult.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    page = [row._asdict() for row in rows[:limit]]
+    next_cursor = (page[-1]["timestamp"], page[-1]["id"]) if len(rows) > limit else None
+    return page, next_cursor
+
+
+def get_analysis_history_version(db: Session, user_id: int):
+    """
+    (count, newest id) of a user's analyses, read from the owner/timestamp
+    index. Analyses are only ever added, so this changes whenever any page of
+    the history does.
+    """
+    result = models.AnalysisResult
+    count, latest_id = (
+        db.query(func.count(result.id), func.max(result.id))
+        .filter(result.owner_id == user_id)
+        .one()
+    )
+    return count, latest_id
+
+
+# --- Analysis Cache ---
+def get_cached_analysis(db: Session, key: str, max_age_seconds: int):
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age_seconds)
+    return (
+        db.query(models.AnalysisCacheEntry)
+        .filter(models.AnalysisCacheEntry.key == key, models.AnalysisCacheEntry.created_at >= cutoff)
+        .first()
+    )
+
+
+def save_cached_analysis(db: Session, key: str, result: dict, latency_ms: float):
+    db.merge(models.AnalysisCacheEntry(
+        key=key,
+        result=result,
+        latency_ms=latency_ms,
+        created_at=datetime.datetime.utcnow()
+    ))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another worker cached the same analysis first; its entry is just as good
+        db.rollback()
+
+
+def purge_expired_cache(db: Session, max_age_seconds: int) -> int:
+    """Deletes cache entries older than max_age_seconds (a range scan on the created_at index)."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age_seconds)
+    deleted = (
+        db.query(models.AnalysisCacheEntry)
+        .filter(models.AnalysisCacheEntry.created_at < cutoff)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return deleted
+
+
+# --- Farm Locations & Outbreak Rollups ---
+_ROLLUP_KEY = ["cell_lat", "cell_lon", "day", "crop_type", "disease_name"]
+_rollup_upserts = {}
+
+
+def _outbreak_upsert(dialect_name: str):
+    """
+    INSERT ... SELECT from the farm's cell and crop, adding to the existing
+    count on conflict. Built once per dialect and run with executemany.
+    """
+    if dialect_name not in _rollup_upserts:
+        dialect_insert = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}[dialect_name]
+        farm = models.Farm
+        source = select(
+            farm.cell_lat,
+            farm.cell_lon,
+            bindparam("day", type_=Date),
+            func.coalesce(farm.crop_type, ""),
+            bindparam("disease_name", type_=String),
+            bindparam("diagnoses", type_=Integer),
+        ).where(farm.id == bindparam("farm_id"), farm.cell_lat.isnot(None))
+        rollup = models.OutbreakRollup.__table__
+        statement = dialect_insert(rollup).from_select(_ROLLUP_KEY + ["diagnoses"], source)
+        _rollup_upserts[dialect_name] = statement.on_conflict_do_update(
+            index_elements=_ROLLUP_KEY,
+            set_={"diagnoses": rollup.c.diagnoses + statement.excluded.diagnoses},
+        )
+    return _rollup_upserts[dialect_name]
+
+
+def record_outbreak_counts(db: Session, diagnoses: list):
+    """
+    Adds (farm_id, disease_name, timestamp) diagnoses to the outbreak rollups
+    without committing. A timestamp of None means now; non-diagnoses are skipped.
+    """
+    counts = Counter()
+    today = datetime.datetime.utcnow().date()
+    for farm_id, disease_name, timestamp in diagnoses:
+        disease_name = geo.normalize_disease_name(disease_name)
+        if farm_id is None or disease_name is None:
+            continue
+        counts[(farm_id, disease_name, timestamp.date() if timestamp else today)] += 1
+    if not counts:
+        return
+    db.execute(_outbreak_upsert(db.get_bind().dialect.name), [
+        {"farm_id": farm_id, "disease_name": disease_name, "day": day, "diagnoses": count}
+        for (farm_id, disease_name, day), count in counts.items()
+    ])
+
+
+def get_outbreak_counts(db: Session, cell_lat_range: tuple, cell_lon_range: tuple, since: datetime.date,
+                        disease_name: str = None, crop_type: str = None):
+    """(cell_lat, cell_lon, disease_name, day, diagnoses) rollup rows in a box of cells since a day."""
+    rollup = models.OutbreakRollup
+    query = db.query(rollup.cell_lat, rollup.cell_lon, rollup.disease_name, rollup.day, rollup.diagnoses).filter(
+        rollup.cell_lat.between(*cell_lat_range),
+        rollup.cell_lon.between(*cell_lon_range),
+        rollup.day >= since,
+    )
+    if disease_name:
+        query = query.filter(func.lower(rollup.disease_name) == disease_name.strip().lower())
+    if crop_type:
+        query = query.filter(func.lower(rollup.crop_type) == crop_type.strip().lower())
+    return query.all()
+
+
+def backfill_farm_locations(db: Session, only_missing: bool = True) -> int:
+    """Fills the typed coordinate and cell columns from the location JSON."""
+    query = db.query(models.Farm)
+    if only_missing:
+        query = query.filter(models.Farm.cell_lat.is_(None))
+    updated = 0
+    for farm in query:
+        location = json.loads(farm.location) if isinstance(farm.location, str) else farm.location
+        try:
+            columns = geo.location_columns(location)
+        except (KeyError, TypeError, ValueError):
+            continue
+        for field, value in columns.items():
+            setattr(farm, field, value)
+        updated += 1
+    db.commit()
+    return updated
+
+
+def rebuild_outbreak_rollups(db: Session) -> int:
+    """Recomputes every rollup row from the saved analyses."""
+    db.query(models.OutbreakRollup).delete()
+    analysis, farm = models.AnalysisResult, models.Farm
+    totals = Counter()
+    rows = (
+        db.query(farm.cell_lat, farm.cell_lon, func.date(analysis.timestamp), farm.crop_type,
+                 analysis.online_disease_name, func.count())
+        .join(farm, farm.id == analysis.farm_id)
+        .filter(farm.cell_lat.isnot(None))
+        .group_by(farm.cell_lat, farm.cell_lon, func.date(analysis.timestamp), farm.crop_type, analysis.online_disease_name)
+    )
+    for cell_lat, cell_lon, day, crop_type, disease_name, count in rows:
+        disease_name = geo.normalize_disease_name(disease_name)
+        if disease_name is None or day is None:
+            continue
+        if isinstance(day, str):
+            day = datetime.date.fromisoformat(day)
+        totals[(cell_lat, cell_lon, day, crop_type or "", disease_name)] += count
+    if totals:
+        db.execute(insert(models.OutbreakRollup), [
+            dict(zip(_ROLLUP_KEY, key), diagnoses=count) for key, count in totals.items()
+        ])
+    db.commit()
+    return len(totals)
+
+
+def outbreak_rollups_missing(db: Session) -> bool:
+    """True when analyses exist but the rollups are empty, e.g. right after the table was added."""
+    return (
+        db.query(models.OutbreakRollup.cell_lat).first() is None
+        and db.query(models.AnalysisResult.id).first() is not None
+    )
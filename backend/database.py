@@ -1,23 +1,178 @@
 import os
-from sqlalchemy import create_engine
+import time
+import threading
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+# --- Connection Pool Settings ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))  # 0 = no timeout (Postgres only)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine) 
+
+def _async_database_url(url: str) -> str:
+    """Maps the sync DATABASE_URL onto its asyncio driver (asyncpg / aiosqlite)."""
+    scheme, sep, rest = url.partition("://")
+    driver = scheme.split("+")[0]
+    if driver in ("postgres", "postgresql"):
+        # asyncpg spells libpq's sslmode as ssl
+        return "postgresql+asyncpg://" + rest.replace("sslmode=", "ssl=")
+    if driver == "sqlite":
+        return "sqlite+aiosqlite://" + rest
+    raise ValueError(f"No async driver configured for '{scheme}' URLs; set DATABASE_ASYNC_URL")
+
+
+DATABASE_ASYNC_URL = os.getenv("DATABASE_ASYNC_URL") or _async_database_url(DATABASE_URL)
+
+
+# --- Pool Metrics ---
+class PoolMetrics:
+    """Counts checkouts and how long callers waited for a pooled connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, wait_seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_seconds_total += wait_seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+
+    def snapshot(self, pool) -> dict:
+        capacity = DB_POOL_SIZE + DB_MAX_OVERFLOW
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+                "wait_seconds_avg": round(self.wait_seconds_total / self.checkouts, 6) if self.checkouts else 0.0,
+                "size": pool.size(),
+                "max_overflow": DB_MAX_OVERFLOW,
+                "checked_out": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "utilization": round(pool.checkedout() / capacity, 4) if capacity else 0.0,
+            }
+
+
+class _TimedPoolMixin:
+    metrics: PoolMetrics
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.metrics.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - started)
+        return connection
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    metrics = PoolMetrics()
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    metrics = PoolMetrics()
+
+
+def _engine_options(url: str, is_async: bool) -> dict:
+    if url.startswith("sqlite") and (":memory:" in url or url.rstrip("/").endswith(":")):
+        return {}  # In-memory SQLite keeps SQLAlchemy's single-connection pool
+
+    options = {
+        "poolclass": TimedAsyncQueuePool if is_async else TimedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    if DB_STATEMENT_TIMEOUT_MS and url.startswith("postgres"):
+        if is_async:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL, is_async=False))
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Used by the async endpoints so database waits don't block the event loop.
+# expire_on_commit=False lets handlers commit early (returning the connection to
+# the pool before a slow model call) and keep using the loaded objects.
+async_engine = create_async_engine(DATABASE_ASYNC_URL, **_engine_options(DATABASE_ASYNC_URL, is_async=True))
+
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
+def create_missing_indexes():
+    """create_all skips indexes on tables that already exist; add any that are new."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def add_missing_columns():
+    """
+    create_all doesn't alter tables that already exist, so columns added to the
+    models later are added here. Only nullable columns can be added this way.
+    """
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column_type}"
+                ))
+                print(f"Added column {table.name}.{column.name}")
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
-        
\ No newline at end of file
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def pool_stats() -> dict:
+    """Checkout wait times and utilization of the sync and async connection pools."""
+    stats = {}
+    for name, pool in (("sync", engine.pool), ("async", async_engine.pool)):
+        if isinstance(pool, _TimedPoolMixin):
+            stats[name] = pool.metrics.snapshot(pool)
+    return stats
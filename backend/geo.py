@@ -0,0 +1,81 @@
+# backend/geo.py
+
+import os
+import math
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Grid Settings ---
+# Farms are bucketed into square lat/lon cells of GEO_CELL_DEGREES (0.05° is
+# about 5.5 km north-south), and outbreak rollups count diagnoses per cell, so a
+# radius query only touches the handful of cells around the point. Changing the
+# cell size needs a rollup rebuild: python geo.py rebuild
+GEO_CELL_DEGREES = float(os.getenv("GEO_CELL_DEGREES", "0.05"))
+EARTH_RADIUS_KM = 6371.0
+
+# Answers that aren't a diagnosis and shouldn't count towards an outbreak
+NOT_DIAGNOSES = {"", "unknown", "unconfirmed"}
+
+
+def cell_of(lat: float, lon: float) -> Tuple[int, int]:
+    """The (cell_lat, cell_lon) grid indexes of a point."""
+    return math.floor(lat / GEO_CELL_DEGREES), math.floor(lon / GEO_CELL_DEGREES)
+
+
+def location_columns(location) -> dict:
+    """Typed Farm columns for a {lat, lon} location (a dict or schemas.Location)."""
+    if not isinstance(location, dict):
+        location = location.model_dump()
+    lat, lon = float(location["lat"]), float(location["lon"])
+    cell_lat, cell_lon = cell_of(lat, lon)
+    return {"latitude": lat, "longitude": lon, "cell_lat": cell_lat, "cell_lon": cell_lon}
+
+
+def normalize_disease_name(name: Optional[str]) -> Optional[str]:
+    """Collapses whitespace; returns None for answers that aren't a diagnosis."""
+    name = " ".join((name or "").split())
+    return None if name.lower() in NOT_DIAGNOSES else name
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def cell_ranges(lat: float, lon: float, radius_km: float) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """Inclusive (cell_lat, cell_lon) index ranges of the bounding box of a circle."""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    dlon = math.degrees(radius_km / (EARTH_RADIUS_KM * max(math.cos(math.radians(lat)), 1e-6)))
+    low, high = cell_of(lat - dlat, lon - dlon), cell_of(lat + dlat, lon + dlon)
+    return (low[0], high[0]), (low[1], high[1])
+
+
+def cell_in_radius(cell_lat: int, cell_lon: int, lat: float, lon: float, radius_km: float) -> bool:
+    """Whether any part of the cell lies within radius_km of the point."""
+    nearest_lat = min(max(lat, cell_lat * GEO_CELL_DEGREES), (cell_lat + 1) * GEO_CELL_DEGREES)
+    nearest_lon = min(max(lon, cell_lon * GEO_CELL_DEGREES), (cell_lon + 1) * GEO_CELL_DEGREES)
+    return haversine_km(lat, lon, nearest_lat, nearest_lon) <= radius_km
+
+
+def cell_size_km(lat: float) -> Tuple[float, float]:
+    """Approximate (north-south, east-west) size of a cell at this latitude."""
+    height = math.radians(GEO_CELL_DEGREES) * EARTH_RADIUS_KM
+    return round(height, 2), round(height * math.cos(math.radians(lat)), 2)
+
+
+# --- Example Usage ---
+if __name__ == "__main__":
+    # python geo.py rebuild  -> recompute farm cells and every rollup from the raw analyses
+    import sys
+    import crud
+    from database import SessionLocal
+
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python geo.py rebuild")
+    with SessionLocal() as db:
+        farms = crud.backfill_farm_locations(db, only_missing=False)
+        rows = crud.rebuild_outbreak_rollups(db)
+    print(f"Updated {farms} farms and rebuilt {rows} rollup rows.")
@@ -0,0 +1,64 @@
+# backend/imaging.py
+
+import os
+import io
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Preprocessing Settings ---
+# Photos are shrunk and re-encoded before they are sent to Gemini; the model
+# doesn't need a 12 MP image to spot leaf rust.
+MAX_IMAGE_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1024"))
+MAX_IMAGE_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(300 * 1024)))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # "JPEG" or "WEBP"
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+MIN_IMAGE_QUALITY = 50
+# Uploads larger than this are rejected before they are decoded
+MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(15 * 1024 * 1024)))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+class InvalidImageError(ValueError):
+    """Raised when the uploaded bytes can't be decoded as an image."""
+
+
+def prepared_mime_type() -> str:
+    """The MIME type of the bytes returned by prepare_image."""
+    return MIME_TYPES.get(IMAGE_FORMAT, "image/jpeg")
+
+
+def prepare_image(image_data: bytes) -> bytes:
+    """
+    Decodes an uploaded photo, applies its EXIF rotation, caps its longest side
+    at MAX_IMAGE_DIMENSION and re-encodes it as a compact JPEG/WebP, lowering
+    the quality (and then the size) until it fits in MAX_IMAGE_BYTES.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        img = Image.open(io.BytesIO(image_data))
+        img.draft("RGB", (MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))  # Cheap JPEG downscale while decoding
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+    except Exception as e:
+        raise InvalidImageError(f"Could not decode image: {e}")
+
+    img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+
+    image_format = IMAGE_FORMAT if IMAGE_FORMAT in MIME_TYPES else "JPEG"
+    while True:
+        quality = IMAGE_QUALITY
+        while True:
+            buffer = io.BytesIO()
+            img.save(buffer, format=image_format, quality=quality)
+            encoded = buffer.getvalue()
+            if len(encoded) <= MAX_IMAGE_BYTES or quality <= MIN_IMAGE_QUALITY:
+                break
+            quality -= 10
+
+        if len(encoded) <= MAX_IMAGE_BYTES or max(img.size) <= 256:
+            return encoded
+        img = img.resize((int(img.width * 0.75), int(img.height * 0.75)))
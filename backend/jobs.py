@@ -0,0 +1,137 @@
+# backend/jobs.py
+
+import os
+import uuid
+import time
+import asyncio
+from typing import Awaitable, Callable, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Job Queue Settings ---
+JOB_WORKERS = int(os.getenv("ANALYSIS_JOB_WORKERS", "4"))
+JOB_MAX_QUEUED = int(os.getenv("ANALYSIS_JOB_MAX_QUEUED", "100"))
+JOB_RESULT_TTL = int(os.getenv("ANALYSIS_JOB_RESULT_TTL", "3600"))  # seconds a finished job stays pollable
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue already holds JOB_MAX_QUEUED jobs."""
+
+
+class AnalysisJob:
+    """One queued analysis: its inputs, its state and, once finished, its outcome."""
+
+    def __init__(self, owner, image_data: bytes, user_query: str, language_code: str):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.image_data = image_data
+        self.user_query = user_query
+        self.language_code = language_code
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._changed = asyncio.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self) -> dict:
+        data = {"jobId": self.id, "status": self.status}
+        if self.status == DONE:
+            data["result"] = self.result
+        elif self.status == FAILED:
+            data["error"] = self.error
+        return data
+
+    async def set_status(self, status: str):
+        async with self._changed:
+            self.status = status
+            if self.finished:
+                self.finished_at = time.time()
+                self.image_data = None  # Don't keep the photo around once it's analysed
+            self._changed.notify_all()
+
+    async def wait_for_change(self, seen_status: str, timeout: float) -> bool:
+        """Waits until the status differs from seen_status; returns False on timeout."""
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait_for(lambda: self.status != seen_status), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+
+class JobQueue:
+    """
+    In-process analysis queue drained by a fixed pool of asyncio workers.
+    Jobs live in this worker process's memory, so polls must reach the same
+    uvicorn worker that accepted the job (single worker or sticky sessions).
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_MAX_QUEUED, result_ttl: int = JOB_RESULT_TTL):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._jobs = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._handler = None
+
+    async def start(self, handler: Callable[[AnalysisJob], Awaitable[dict]]):
+        """Starts the worker pool; handler runs one job and returns its result."""
+        self._handler = handler
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, owner, image_data: bytes, user_query: str, language_code: str) -> AnalysisJob:
+        if self._queue is None:
+            raise RuntimeError("Job queue has not been started")
+        self._prune()
+        if self._queue.qsize() >= self.max_queued:
+            raise QueueFullError("Too many analyses are waiting. Please try again shortly.")
+        job = AnalysisJob(owner, image_data, user_query, language_code)
+        self._jobs[job.id] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[AnalysisJob]:
+        return self._jobs.get(job_id)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await job.set_status(RUNNING)
+                job.result = await self._handler(job)
+                await job.set_status(DONE)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.error = getattr(e, "detail", None) or "Failed to get analysis from AI. Please try again."
+                job.status_code = getattr(e, "status_code", 500)
+                print(f"   -> Analysis job {job.id} failed: {job.error}")
+                await job.set_status(FAILED)
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+queue = JobQueue()
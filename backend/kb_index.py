@@ -0,0 +1,293 @@
+# backend/kb_index.py
+#
+# Builds the knowledge-base index artifact: a versioned SQLite file holding the
+# chunked guide text (with source file and character offsets), per-chunk token
+# statistics and the BM25 postings. The server queries this file instead of
+# re-parsing every guide in every worker.
+#
+#   python kb_index.py build [--kb knowledge_base] [--force]
+#   python kb_index.py stats
+#   python kb_index.py search "coffee leaf rust"
+
+import os
+import time
+import heapq
+import sqlite3
+import hashlib
+import argparse
+import threading
+from collections import Counter, defaultdict
+from dotenv import load_dotenv
+
+from rag_tool import (
+    Hit, tokenize, chunk_document, bm25_score, REFRESH_INTERVAL, CHUNKER_SIGNATURE,
+)
+
+load_dotenv()
+
+# --- Artifact Settings ---
+# Bump INDEX_FORMAT_VERSION whenever the schema or tokenizer changes; older
+# artifacts are then rebuilt from scratch.
+INDEX_FORMAT_VERSION = 1
+INDEX_FILENAME = ".kb_index.sqlite"
+INDEX_PATH = os.getenv("RAG_INDEX_PATH")  # default: <knowledge_base>/.kb_index.sqlite
+# Let the server (re)build a missing or stale artifact itself
+AUTO_BUILD = os.getenv("RAG_INDEX_AUTO_BUILD", "1") == "1"
+MMAP_BYTES = int(os.getenv("RAG_INDEX_MMAP_BYTES", str(256 * 1024 * 1024)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY, file TEXT NOT NULL, start INTEGER NOT NULL, "end" INTEGER NOT NULL,
+    length INTEGER NOT NULL, text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_chunks_file ON chunks (file);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL, chunk_id INTEGER NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, chunk_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_postings_chunk ON postings (chunk_id);
+"""
+
+
+def default_index_path(knowledge_base_path: str) -> str:
+    return INDEX_PATH or os.path.join(knowledge_base_path, INDEX_FILENAME)
+
+
+def _scan_files(knowledge_base_path: str) -> dict:
+    files = {}
+    for entry in os.scandir(knowledge_base_path):
+        if entry.name.endswith(".txt") and entry.is_file():
+            stat = entry.stat()
+            files[entry.name] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def _delete_file(conn: sqlite3.Connection, name: str):
+    conn.execute("DELETE FROM postings WHERE chunk_id IN (SELECT id FROM chunks WHERE file = ?)", (name,))
+    conn.execute("DELETE FROM chunks WHERE file = ?", (name,))
+    conn.execute("DELETE FROM files WHERE name = ?", (name,))
+
+
+def _index_file(conn: sqlite3.Connection, name: str, content: str) -> int:
+    chunk_count = 0
+    for start, end in chunk_document(content):
+        text = content[start:end]
+        term_counts = Counter(tokenize(text))
+        if not term_counts:
+            continue
+        cursor = conn.execute(
+            'INSERT INTO chunks (file, start, "end", length, text) VALUES (?, ?, ?, ?, ?)',
+            (name, start, end, sum(term_counts.values()), text),
+        )
+        conn.executemany(
+            "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)",
+            [(term, cursor.lastrowid, tf) for term, tf in term_counts.items()],
+        )
+        chunk_count += 1
+    return chunk_count
+
+
+def build_index(knowledge_base_path: str, index_path: str = None, force: bool = False) -> dict:
+    """
+    Brings the artifact up to date with the .txt files in knowledge_base_path.
+    Only files whose content hash changed are re-chunked; a format or chunker
+    change (or force=True) rebuilds everything. Concurrent builders are
+    serialised by SQLite's write lock. Returns counts of what was done.
+    """
+    index_path = index_path or default_index_path(knowledge_base_path)
+    summary = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "chunks_written": 0}
+
+    conn = sqlite3.connect(index_path, timeout=60, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        if (force or meta.get("format_version") != str(INDEX_FORMAT_VERSION)
+                or meta.get("chunker") != CHUNKER_SIGNATURE):
+            for table in ("postings", "chunks", "files", "meta"):
+                conn.execute(f"DELETE FROM {table}")
+            meta = {}
+
+        indexed = {name: (sha, size, mtime) for name, sha, size, mtime in conn.execute("SELECT name, sha256, size, mtime FROM files")}
+        current = _scan_files(knowledge_base_path)
+
+        for name in indexed.keys() - current.keys():
+            _delete_file(conn, name)
+            summary["removed"] += 1
+
+        for name, (size, mtime) in sorted(current.items()):
+            old = indexed.get(name)
+            if old is not None and old[1] == size and old[2] == mtime:
+                summary["unchanged"] += 1
+                continue
+
+            with open(os.path.join(knowledge_base_path, name), "rb") as f:
+                data = f.read()
+            sha = hashlib.sha256(data).hexdigest()
+            if old is not None and old[0] == sha:
+                # Touched but not edited: just remember the new mtime
+                conn.execute("UPDATE files SET size = ?, mtime = ? WHERE name = ?", (size, mtime, name))
+                summary["unchanged"] += 1
+                continue
+
+            if old is not None:
+                _delete_file(conn, name)
+            # Chunk offsets are character offsets into the UTF-8 decoded file
+            summary["chunks_written"] += _index_file(conn, name, data.decode("utf-8", errors="replace"))
+            conn.execute("INSERT INTO files (name, sha256, size, mtime) VALUES (?, ?, ?, ?)", (name, sha, size, mtime))
+            summary["updated" if old is not None else "added"] += 1
+
+        if summary["added"] or summary["updated"] or summary["removed"] or not meta:
+            chunk_count, total_length = conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks").fetchone()
+            conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [
+                ("format_version", str(INDEX_FORMAT_VERSION)),
+                ("chunker", CHUNKER_SIGNATURE),
+                ("chunk_count", str(chunk_count)),
+                ("total_length", str(total_length)),
+                ("generation", str(int(meta.get("generation", "0")) + 1)),
+                ("built_at", str(time.time())),
+            ])
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return summary
+
+
+class KnowledgeBaseArtifact:
+    """
+    Serves BM25 searches straight from the SQLite artifact. Each thread opens
+    its own read-only connection with the file memory-mapped, so workers share
+    the OS page cache instead of each holding the corpus in Python objects.
+    Offers the same search() as rag_tool.KnowledgeBaseIndex.
+    """
+
+    def __init__(self, knowledge_base_path: str, index_path: str = None):
+        self.knowledge_base_path = knowledge_base_path
+        self.index_path = index_path or default_index_path(knowledge_base_path)
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{os.path.abspath(self.index_path)}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size={MMAP_BYTES}")
+            self._local.conn = conn
+        return conn
+
+    def is_current(self) -> bool:
+        """True when the artifact matches the format and the files on disk (by size and mtime)."""
+        try:
+            conn = self._connection()
+            meta = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('format_version', 'chunker')"))
+            indexed = {name: (size, mtime) for name, size, mtime in conn.execute("SELECT name, size, mtime FROM files")}
+        except sqlite3.Error:
+            return False
+        return (meta.get("format_version") == str(INDEX_FORMAT_VERSION)
+                and meta.get("chunker") == CHUNKER_SIGNATURE
+                and indexed == _scan_files(self.knowledge_base_path))
+
+    def refresh(self, force: bool = False):
+        """Rebuilds the changed files (when AUTO_BUILD is on) at most every REFRESH_INTERVAL seconds."""
+        now = time.monotonic()
+        if not force and self._last_refresh and now - self._last_refresh < REFRESH_INTERVAL:
+            return
+        with self._refresh_lock:
+            self._last_refresh = now
+            if AUTO_BUILD and not self.is_current():
+                summary = build_index(self.knowledge_base_path, self.index_path)
+                print(f"Knowledge-base index updated: {summary}")
+
+    def stats(self) -> dict:
+        conn = self._connection()
+        stats = dict(conn.execute("SELECT key, value FROM meta"))
+        stats["files"] = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        stats["terms"] = conn.execute("SELECT COUNT(DISTINCT term) FROM postings").fetchone()[0]
+        stats["bytes"] = os.path.getsize(self.index_path)
+        return stats
+
+    def search(self, query: str, top_k: int = 3) -> list:
+        """Returns up to top_k rag_tool.Hits ranked by BM25."""
+        self.refresh()
+        terms = list(set(tokenize(query)))
+        if not terms:
+            return []
+
+        conn = self._connection()
+        meta = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('chunk_count', 'total_length')"))
+        doc_count = int(meta.get("chunk_count", "0"))
+        if doc_count == 0:
+            return []
+        avg_length = int(meta["total_length"]) / doc_count
+
+        postings = defaultdict(list)
+        placeholders = ", ".join("?" * len(terms))
+        for term, chunk_id, tf, length in conn.execute(
+            f"SELECT p.term, p.chunk_id, p.tf, c.length FROM postings p JOIN chunks c ON c.id = p.chunk_id "
+            f"WHERE p.term IN ({placeholders})", terms,
+        ):
+            postings[term].append((chunk_id, tf, length))
+
+        scores = defaultdict(float)
+        for term_postings in postings.values():
+            df = len(term_postings)
+            for chunk_id, tf, length in term_postings:
+                scores[chunk_id] += bm25_score(tf, df, doc_count, length, avg_length)
+
+        # The same paragraph can appear in several guides; keep its best score only
+        candidates = heapq.nlargest(top_k * 3, scores.items(), key=lambda x: x[1])
+        if not candidates:
+            return []
+        chunks = {chunk_id: (text, file) for chunk_id, text, file in conn.execute(
+            f"SELECT id, text, file FROM chunks WHERE id IN ({', '.join('?' * len(candidates))})",
+            [chunk_id for chunk_id, _ in candidates],
+        )}
+        best = {}
+        for chunk_id, score in candidates:
+            text, file = chunks[chunk_id]
+            best.setdefault(text, Hit(score, text, file))
+        return list(best.values())[:top_k]
+
+
+def load_index(knowledge_base_path: str, index_path: str = None) -> KnowledgeBaseArtifact:
+    """Opens the artifact for a knowledge-base folder, building or updating it first if allowed."""
+    index_path = index_path or default_index_path(knowledge_base_path)
+    if AUTO_BUILD:
+        build_index(knowledge_base_path, index_path)
+    elif not os.path.exists(index_path):
+        raise FileNotFoundError(f"No knowledge-base index at {index_path}; run 'python kb_index.py build'")
+    index = KnowledgeBaseArtifact(knowledge_base_path, index_path)
+    index._last_refresh = time.monotonic()
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or inspect the knowledge-base index artifact.")
+    parser.add_argument("command", nargs="?", default="build", choices=["build", "stats", "search"])
+    parser.add_argument("query", nargs="?", default="", help="query for the search command")
+    parser.add_argument("--kb", default="knowledge_base", help="knowledge-base folder")
+    parser.add_argument("--output", default=None, help="artifact path (default: <kb>/%s)" % INDEX_FILENAME)
+    parser.add_argument("--force", action="store_true", help="rebuild every file")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        summary = build_index(args.kb, args.output, force=args.force)
+        print(f"{summary} in {time.perf_counter() - started:.2f}s -> {args.output or default_index_path(args.kb)}")
+    else:
+        artifact = KnowledgeBaseArtifact(args.kb, args.output)
+        if args.command == "stats":
+            print(artifact.stats())
+        else:
+            for score, para, source in artifact.search(args.query):
+                print(f"{score:.3f}  {source}  {para[:120]!r}")
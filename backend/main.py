@@ -1,21 +1,85 @@
 # backend/main.py
 
-from fastapi import FastAPI, Depends, HTTPException, status
+import time
+_import_started = time.perf_counter()  # Boot-time accounting, see /api/v1/startup/stats
+
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
 from sqlalchemy.orm import Session
-from pydantic import BaseModel
-from datetime import datetime
-from typing import List
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel, field_validator
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+import os
 import json
+import base64
+import asyncio
+import functools
+
+import models, schemas, crud, security, agent, rag_tool, analysis_cache, imaging, jobs, ratelimit, writebehind, classifier, metrics, resilience, geo, responses, blobstore
+from database import engine, get_db, get_async_db, SessionLocal, AsyncSessionLocal, pool_stats, create_missing_indexes, add_missing_columns
+
+# --- Startup ---
+# Nothing slow runs at import time: the schema, indexes and knowledge base are
+# prepared in the lifespan, and the Gemini SDK is warmed in the background.
+MODEL_WARM_UP = os.getenv("MODEL_WARM_UP", "1") == "1"
+startup_timings = {}
+
+
+def _timed(name: str, fn, *args):
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        startup_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def _create_schema():
+    # Create tables if they don't exist
+    models.Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    create_missing_indexes()
+    # Farms and analyses saved before the outbreak rollups existed
+    with SessionLocal() as db:
+        crud.backfill_farm_locations(db)
+        if crud.outbreak_rollups_missing(db):
+            print(f"Built {crud.rebuild_outbreak_rollups(db)} outbreak rollup rows.")
 
-import models, schemas, crud, security, agent
-from database import engine, get_db
 
-# Create tables if they don't exist
-models.Base.metadata.create_all(bind=engine)
+def _warm_model():
+    try:
+        _timed("model_warm_up_ms", agent.get_model)
+    except Exception as e:
+        print(f"Gemini model warm-up failed: {e}")
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup_timings["import_ms"] = round((_import_finished - _import_started) * 1000, 1)
+    lifespan_started = time.perf_counter()
+    await run_in_threadpool(_timed, "schema_ms", _create_schema)
+    # Build the knowledge-base index up front so the first analysis doesn't pay for it
+    await run_in_threadpool(_timed, "rag_warm_up_ms", rag_tool.warm_up, agent.KNOWLEDGE_BASE_PATH)
+    await jobs.queue.start(_process_analysis_job)
+    if writebehind.WRITE_BEHIND_ENABLED:
+        await writebehind.writer.start()
+    if MODEL_WARM_UP:
+        # A request that needs the model before this finishes waits in agent.get_model()
+        asyncio.get_running_loop().run_in_executor(None, _warm_model)
+    startup_timings["lifespan_ms"] = round((time.perf_counter() - lifespan_started) * 1000, 1)
+    print(f"Startup finished: {startup_timings}")
+    yield
+    await jobs.queue.stop()
+    # Drain queued results before the process exits
+    await writebehind.writer.stop()
+    security.shutdown_hash_executor()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=responses.FastJSONResponse)
 
 origins = [
     "http://localhost:3000", 
@@ -29,7 +93,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "ETag", "Last-Modified"],
 )
+# Per-route latency histograms and the Server-Timing header on analyze calls
+app.add_middleware(metrics.MetricsMiddleware)
 
 # --- Pydantic Request Model ---
 class AnalysisRequest(BaseModel):
@@ -38,22 +105,75 @@ class AnalysisRequest(BaseModel):
     location: dict
     languageCode: str
 
+    # Stored with the analysis (language_code is a String(8)) and part of the cache key
+    _normalize_language = field_validator("languageCode")(agent.normalize_language_code)
+
+class BatchAnalysisItem(BaseModel):
+    image: str
+    userQuery: str = ""
+
+class BatchAnalysisRequest(BaseModel):
+    items: List[BatchAnalysisItem]
+    languageCode: str = "en"
+
+    _normalize_language = field_validator("languageCode")(agent.normalize_language_code)
+
+class DiagnosisConfirmation(BaseModel):
+    diseaseName: Optional[str] = None  # A correction; Gemini's diagnosis when left out
+
+BATCH_MAX_IMAGES = int(os.getenv("ANALYSIS_BATCH_MAX_IMAGES", "50"))
+BATCH_CONCURRENCY = int(os.getenv("ANALYSIS_BATCH_CONCURRENCY", "4"))
+# While the Gemini circuit is open, answer from the knowledge base instead of failing
+RAG_FALLBACK_ENABLED = os.getenv("RAG_FALLBACK_ENABLED", "1") == "1"
+
 # --- Authentication Endpoints ---
 @app.post("/api/v1/users/", response_model=schemas.User)
-def create_user_endpoint(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+async def create_user_endpoint(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await db.run_sync(crud.get_user_by_email, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    user_dict = {"email": user.email, "name": user.name, "password": user.password}
-    return crud.create_user(db=db, user_data=user_dict)
+    await db.commit()  # Hand the connection back to the pool while bcrypt runs
+    hashed_password = await security.get_password_hash_async(user.password)
+    user_dict = {"email": user.email, "name": user.name, "hashed_password": hashed_password}
+    return await db.run_sync(crud.create_user, user_data=user_dict)
+
+
+def _too_many_login_attempts(retry_after: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many login attempts. Please try again later.",
+        headers={"Retry-After": str(retry_after)}
+    )
 
 
 @app.post("/api/v1/token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, email=form_data.username)
-    if not user or not security.verify_password(form_data.password, user.hashed_password):
+async def login_for_access_token(
+    request: Request,
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db: AsyncSession = Depends(get_async_db)
+):
+    retry_after = ratelimit.login_ip_limiter.hit(ratelimit.client_ip(request))
+    if not retry_after:
+        retry_after = ratelimit.login_account_limiter.hit(form_data.username.lower())
+    if retry_after:
+        raise _too_many_login_attempts(retry_after)
+
+    user = await db.run_sync(crud.get_user_by_email, email=form_data.username)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
+    claims = {"sub": user.email, "uid": user.id, "name": user.name}
+    hashed_password = user.hashed_password
+    await db.commit()  # Hand the connection back to the pool while bcrypt runs
+
+    is_valid, new_hash = await security.verify_and_update_password_async(form_data.password, hashed_password)
+    if not is_valid:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
-    access_token = security.create_access_token(data={"sub": user.email})
+
+    if new_hash:
+        # BCRYPT_ROUNDS changed since this password was stored; upgrade it transparently
+        await db.run_sync(crud.update_user, user, {"hashed_password": new_hash})
+
+    access_token = security.create_access_token(data=claims)
     return {"access_token": access_token, "token_type": "bearer"}
 
 
@@ -65,25 +185,77 @@ def create_farm_for_user(
     current_user: models.User = Depends(security.get_current_user)
 ):
     db_farm = crud.create_user_farm(db=db, farm=farm, user_id=current_user.id)
-    
-    # --- Fix: convert string to dict before validating ---
-    if isinstance(db_farm.location, str):
-        location_dict = json.loads(db_farm.location)
-    else:
-        location_dict = db_farm.location
+    return responses.FastJSONResponse(crud.farm_payload(db_farm))
 
-    db_farm.location = schemas.Location.model_validate(location_dict)
 
-    return db_farm
+@app.get("/api/v1/farms/me", response_model=List[schemas.Farm])
+def read_my_farms(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(security.get_current_user)
+):
+    """The user's farms; send the ETag back in If-None-Match to get a 304 when nothing changed."""
+    farms, last_modified = crud.get_farm_rows(db, user_id=current_user.id)
+    body = responses.dumps(farms)
+    headers = responses.validator_headers(responses.make_etag(body), last_modified)
+    if responses.is_not_modified(request, headers["ETag"], last_modified):
+        return responses.not_modified(headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
-@app.get("/api/v1/farms/me", response_model=List[schemas.Farm])
-def read_my_farms(db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_user)):
-    farms = crud.get_farms_by_user(db, user_id=current_user.id)
-    # Convert all farm locations to Pydantic Location objects
-    for farm in farms:
-        farm.location = schemas.Location(**farm.location)
-    return farms
+# --- Outbreak Analytics ---
+OUTBREAK_MAX_RADIUS_KM = 100
+OUTBREAK_MAX_DAYS = 365
+
+
+@app.get("/api/v1/outbreaks")
+async def read_outbreaks(
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lon: Optional[float] = Query(None, ge=-180, le=180),
+    radius_km: float = Query(10, gt=0, le=OUTBREAK_MAX_RADIUS_KM),
+    days: int = Query(14, ge=1, le=OUTBREAK_MAX_DAYS),
+    disease: Optional[str] = None,
+    crop_type: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(security.get_current_user)
+):
+    """
+    Diagnoses within radius_km of a point (the user's farm by default) over the
+    last `days` days, read from the outbreak rollups rather than the raw
+    analyses. Counts are kept per grid cell (see geo.py), so cells crossing the
+    edge of the circle are counted whole.
+    """
+    if lat is None or lon is None:
+        db_farm = await _get_user_farm(db, current_user)
+        lat, lon = db_farm.latitude, db_farm.longitude
+        if lat is None or lon is None:
+            raise HTTPException(status_code=400, detail="Your farm has no coordinates; pass lat and lon.")
+
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    lat_range, lon_range = geo.cell_ranges(lat, lon, radius_km)
+    rows = await db.run_sync(crud.get_outbreak_counts, lat_range, lon_range, since, disease, crop_type)
+
+    by_disease, by_day, cells = {}, {}, set()
+    for cell_lat, cell_lon, disease_name, day, diagnoses in rows:
+        if not geo.cell_in_radius(cell_lat, cell_lon, lat, lon, radius_km):
+            continue
+        # Gemini doesn't always capitalise a disease the same way
+        entry = by_disease.setdefault(disease_name.lower(), {"diseaseName": disease_name, "count": 0})
+        entry["count"] += diagnoses
+        by_day[day] = by_day.get(day, 0) + diagnoses
+        cells.add((cell_lat, cell_lon))
+
+    return {
+        "center": {"lat": lat, "lon": lon},
+        "radiusKm": radius_km,
+        "since": since.isoformat(),
+        "days": days,
+        "cellSizeKm": geo.cell_size_km(lat),
+        "cells": len(cells),
+        "total": sum(by_day.values()),
+        "diseases": sorted(by_disease.values(), key=lambda entry: entry["count"], reverse=True),
+        "daily": [{"day": day.isoformat(), "count": count} for day, count in sorted(by_day.items())],
+    }
 
 
 # --- Root Endpoint ---
@@ -92,56 +264,831 @@ async def read_root():
     return {"message": "Ceres AI Backend is running!"}
 
 
+# --- Stats Endpoints ---
+# Internal counters for operators; they need a signed-in user. Monitoring
+# should scrape /metrics, which carries the same figures and also accepts
+# METRICS_TOKEN as the bearer token.
+@app.get("/api/v1/cache/stats", dependencies=[Depends(security.get_current_user)])
+def read_cache_stats():
+    return analysis_cache.cache.stats()
+
+
+@app.get("/api/v1/classifier/stats", dependencies=[Depends(security.get_current_user)])
+def read_classifier_stats():
+    return classifier.model.stats()
+
+
+@app.get("/api/v1/db/stats", dependencies=[Depends(security.get_current_user)])
+def read_db_pool_stats():
+    return {**pool_stats(), "write_behind": writebehind.writer.stats()}
+
+
+def _authorize_scrape(token: str = Depends(security.oauth2_scheme), db: Session = Depends(get_db)):
+    if not metrics.is_scrape_token(token):
+        security.get_current_user(token, db)
+
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(_authorize_scrape)])
+def read_metrics():
+    """Prometheus text exposition of this worker's metrics."""
+    return PlainTextResponse(metrics.render_latest(), media_type="text/plain; version=0.0.4")
+
+
+def _collect_runtime_gauges():
+    cache_stats = analysis_cache.cache.stats()
+    families = [
+        ("ceres_analysis_cache_events_total", "counter", "Analysis cache lookups and stores since start.", [
+            ({"event": name}, cache_stats[name]) for name in ("memory_hits", "db_hits", "misses", "stores")
+        ]),
+        ("ceres_analysis_cache_purged_total", "counter", "Expired analysis_cache rows deleted since start.", [
+            ({}, cache_stats["purged"])
+        ]),
+        ("ceres_analysis_cache_entries", "gauge", "Entries in the in-memory analysis cache.", [({}, cache_stats["entries"])]),
+        ("ceres_model_slots_in_use", "gauge", "Gemini calls in flight in this worker.", [
+            ({}, agent.MODEL_MAX_CONCURRENCY - agent._model_slots._value)
+        ]),
+        ("ceres_model_circuit_open", "gauge", "1 while the Gemini circuit breaker is open or probing.", [
+            ({}, int(resilience.breaker.state != resilience.CircuitBreaker.CLOSED))
+        ]),
+        ("ceres_model_calls_in_flight", "gauge", "Distinct Gemini calls that requests are waiting on.", [
+            ({}, resilience.flights.stats()["in_flight"])
+        ]),
+        ("ceres_write_behind_pending", "gauge", "Analysis rows waiting to be written.", [
+            ({}, writebehind.writer.stats()["pending"])
+        ]),
+        ("ceres_classifier_samples", "gauge", "Training samples held by the local classifier.", [
+            ({}, classifier.model.sample_count)
+        ]),
+    ]
+    # One family per statistic, with a sample per pool (sync, async)
+    pools = pool_stats()
+    for key, kind in (
+        ("checked_out", "gauge"), ("idle", "gauge"), ("utilization", "gauge"),
+        ("wait_seconds_max", "gauge"), ("wait_seconds_avg", "gauge"),
+        ("timeouts", "counter"), ("checkouts", "counter"), ("wait_seconds", "counter"),
+    ):
+        name = f"ceres_db_pool_{key}_total" if kind == "counter" else f"ceres_db_pool_{key}"
+        stat = f"{key}_total" if key == "wait_seconds" else key
+        families.append((name, kind, f"Connection pool {key.replace('_', ' ')}.", [
+            ({"pool": pool_name}, stats[stat]) for pool_name, stats in pools.items()
+        ]))
+    return families
+
+
+metrics.registry.add_collector(_collect_runtime_gauges)
+
+
+@app.get("/api/v1/startup/stats", dependencies=[Depends(security.get_current_user)])
+def read_startup_stats():
+    """How long this worker took to import the app and run each startup step (ms)."""
+    return startup_timings
+
+
 # --- Analysis Endpoints ---
-@app.post("/api/v1/analyze")
-async def analyze_image(
-    request: AnalysisRequest, 
-    db: Session = Depends(get_db), 
-    current_user: models.User = Depends(security.get_current_user)
-):
-    # Step 1: Get the user's farm
-    db_farm = crud.get_farm_by_owner(db, owner_id=current_user.id)
+async def _get_user_farm(db: AsyncSession, current_user: models.User) -> models.Farm:
+    with metrics.timed("farm_lookup"):
+        db_farm = await db.run_sync(crud.get_farm_by_owner, owner_id=current_user.id)
     if not db_farm:
         raise HTTPException(status_code=404, detail="No farm found for the current user. Please create a farm first.")
+    return db_farm
+
+
+def _analysis_result_to_save(
+    user_query: str,
+    online_result: dict,
+    prediction: classifier.Prediction = classifier.NO_PREDICTION,
+    language_code: Optional[str] = None,
+    image_url: Optional[str] = None
+) -> schemas.AnalysisResultCreate:
+    return schemas.AnalysisResultCreate(
+        user_query=user_query,
+        language_code=language_code,
+        image_url=image_url,
+        offline_disease_name=prediction.disease_name,
+        offline_confidence_score=prediction.confidence,
+        image_features=prediction.features,
+        online_disease_name=online_result.get("diseaseName"),
+        online_severity=online_result.get("severity"),
+        online_summary=online_result.get("summary"),
+        online_recommended_actions=online_result.get("recommendedActions"),
+        online_scientific_reason=online_result.get("scientificReason"),
+        online_preventative_measures=online_result.get("preventativeMeasures")
+    )
+
+
+def _offline_result(prediction: classifier.Prediction) -> dict:
+    return {
+        "diseaseName": prediction.disease_name,
+        "confidence": prediction.confidence,
+        "servedLocally": prediction.served_locally
+    }
+
+
+async def _store_image(image_data: bytes, owner_id: int) -> Optional[str]:
+    """Keeps the uploaded photo (and its thumbnail) in the blob store; returns its URL, or None if that failed."""
+    if not blobstore.BLOB_STORE_ENABLED:
+        return None
+    try:
+        with metrics.timed("blob_store"):
+            key = await run_in_threadpool(blobstore.store.put_image, image_data)
+    except Exception as e:
+        # Not worth failing the analysis over
+        print(f"   -> ERROR storing image: {e}")
+        return None
+    return blobstore.image_url(key, owner_id)
+
 
+async def _classify_photo(image_data: bytes, db: AsyncSession) -> classifier.Prediction:
+    """Runs the local classifier; its features are kept so Gemini's answer can label them."""
+    if not classifier.CLASSIFIER_ENABLED:
+        return classifier.NO_PREDICTION
+    with metrics.timed("classify"):
+        try:
+            features = await run_in_threadpool(classifier.extract_features, image_data)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid image data.")
+        # Only the sample fetch runs on the session's thread; building the
+        # matrix, the radius and the neighbour search go to the threadpool
+        if classifier.model.refresh_due():
+            rows = await db.run_sync(crud.get_classifier_samples, classifier.MAX_SAMPLES)
+            await run_in_threadpool(classifier.model.load_samples, rows)
+        return await run_in_threadpool(classifier.model.predict, features)
+
+
+async def _local_answer(prediction: classifier.Prediction, crop_type: Optional[str], min_confidence: float):
+    """Guide-based answer for the locally predicted disease, if the prediction is confident enough."""
+    if prediction.disease_name == classifier.UNKNOWN or prediction.confidence < min_confidence:
+        return None
+    return await run_in_threadpool(agent.local_diagnosis_result, prediction.disease_name, crop_type)
+
+
+def _may_short_circuit(language_code: str) -> bool:
+    # The guides are in English, so other languages always get Gemini's answer
+    return classifier.SHORT_CIRCUIT_ENABLED and agent.get_language_name(language_code) == "English"
+
+
+async def _save_analysis_result(db: AsyncSession, result: schemas.AnalysisResultCreate, user_id: int, farm_id: int):
+    """Queues the row for the write-behind flusher when it's running, otherwise commits it now."""
+    with metrics.timed("db_write"):
+        if writebehind.writer.running:
+            writebehind.writer.enqueue(result, user_id=user_id, farm_id=farm_id)
+        else:
+            await db.run_sync(crud.create_analysis_result, result=result, user_id=user_id, farm_id=farm_id)
+
+
+async def _analyze_photo(
+    image_data: bytes,
+    user_query: str,
+    language_code: str,
+    db: AsyncSession,
+    db_farm: models.Farm,
+    local_context: Optional[str] = None,
+    wait_for_model: bool = False
+):
+    """
+    Produces the online analysis of one photo: from the cache when possible,
+    from a stored answer when the local classifier is confident, otherwise by
+    preparing the image and calling the agent. Doesn't save anything.
+    With wait_for_model the call queues for a model slot instead of failing fast.
+    Returns (online_result, local classifier prediction).
+    """
     farm_details = {
         "location": db_farm.location,
         "crop_type": db_farm.crop_type,
         "name": db_farm.name
     }
 
-    # Step 2: Call agent
-    online_result = agent.run_analysis_agent(
-        image_base64=request.image,
-        user_query=request.userQuery,
-        farm_details=farm_details,
-        language_code=request.languageCode
-    )
+    # Reuse the analysis of an identical photo and question if we have one
+    cache_key = None
+    if analysis_cache.CACHE_ENABLED:
+        with metrics.timed("cache_lookup"):
+            try:
+                cache_key = await run_in_threadpool(
+                    analysis_cache.make_cache_key, image_data, user_query, db_farm.crop_type, language_code
+                )
+            except Exception:
+                raise HTTPException(status_code=400, detail="Invalid image data.")
+            online_result = await db.run_sync(analysis_cache.cache.get, cache_key)
+        if online_result is not None:
+            print("   -> Serving analysis from cache.")
+            metrics.ANALYSIS_SOURCES.inc("cache")
+            prediction = await _classify_photo(image_data, db)
+            # Don't store the features again: this photo's diagnosis is already a sample
+            return online_result, prediction._replace(features=None)
+
+    prediction = await _classify_photo(image_data, db)
+    local_result = None
+    if _may_short_circuit(language_code):
+        local_result = await _local_answer(prediction, db_farm.crop_type, classifier.SHORT_CIRCUIT_CONFIDENCE)
+    if local_result is not None:
+        print(f"   -> Serving local classifier answer ({prediction.disease_name}, {prediction.confidence}).")
+        metrics.ANALYSIS_SOURCES.inc("local")
+        return local_result, prediction._replace(features=None, served_locally=True)
+
+    # Return the connection to the pool for the duration of the model call
+    await db.commit()
+
+    # Identical photos and questions already being analysed for this farm share
+    # that model call. The prompt names the farm, and the flight runs with its
+    # starter's queueing, so both are part of the key: a batch item that waits
+    # for a slot never joins a request that fails fast when Gemini is busy.
+    content_key = cache_key
+    if content_key is None:
+        try:
+            content_key = await run_in_threadpool(
+                analysis_cache.make_cache_key, image_data, user_query, db_farm.crop_type, language_code
+            )
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid image data.")
+    flight_key = (content_key, db_farm.id, wait_for_model)
+
+    try:
+        online_result = await resilience.flights.do(flight_key, functools.partial(
+            _call_model, image_data, user_query, language_code, farm_details, local_context,
+            wait_for_model, cache_key
+        ))
+    except agent.AgentBusyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except resilience.CircuitOpenError as e:
+        # Gemini is failing: don't add to its load, answer locally if we can
+        fallback = await _fallback_answer(db, prediction, language_code, user_query, local_context, db_farm.crop_type)
+        if fallback is not None:
+            return fallback
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
 
     if "error" in online_result:
+        # Gemini is unreachable or failing: a less certain local answer beats none
+        fallback = await _fallback_answer(db, prediction, language_code, user_query, crop_type=db_farm.crop_type, guides=False)
+        if fallback is not None:
+            return fallback
         raise HTTPException(status_code=500, detail=online_result["error"])
 
+    metrics.ANALYSIS_SOURCES.inc("model")
+    return online_result, prediction
+
+
+async def _call_model(
+    image_data: bytes,
+    user_query: str,
+    language_code: str,
+    farm_details: dict,
+    local_context: Optional[str],
+    wait_for_model: bool,
+    cache_key: Optional[str]
+) -> dict:
+    """
+    Prepares the photo and asks the agent, then caches a successful result.
+    Runs once per single-flight key, so the requests that joined it don't
+    repeat the caching.
+    """
+    # Shrink and re-encode the photo before it goes over the network
+    try:
+        with metrics.timed("image_prepare"):
+            prepared_image = await run_in_threadpool(imaging.prepare_image, image_data)
+    except imaging.InvalidImageError:
+        raise HTTPException(status_code=400, detail="Invalid image data.")
+
+    # Call agent (off the event loop, within the model concurrency cap)
+    started = time.perf_counter()
+    online_result = await agent.run_analysis_agent_async(
+        image_data=prepared_image,
+        user_query=user_query,
+        farm_details=farm_details,
+        language_code=language_code,
+        mime_type=imaging.prepared_mime_type(),
+        local_context=local_context,
+        queue_timeout=None if wait_for_model else agent.MODEL_QUEUE_TIMEOUT
+    )
+    if "error" in online_result:
+        return online_result
+
+    if cache_key:
+        latency_ms = (time.perf_counter() - started) * 1000
+        # A fresh session: the request that started this call may already be gone
+        async with AsyncSessionLocal() as cache_db:
+            await cache_db.run_sync(analysis_cache.cache.put, cache_key, online_result, latency_ms)
+    return online_result
+
+
+async def _fallback_answer(
+    db: AsyncSession,
+    prediction: classifier.Prediction,
+    language_code: str,
+    user_query: str,
+    local_context: Optional[str] = None,
+    crop_type: Optional[str] = None,
+    guides: bool = RAG_FALLBACK_ENABLED
+):
+    """
+    Answers without Gemini: the stored answer for a fairly confident local
+    diagnosis, else (with `guides`) guidance from the knowledge base alone.
+    Returns (online_result, prediction), or None when neither is available.
+    """
+    local_result = await _local_answer(prediction, crop_type, classifier.FALLBACK_CONFIDENCE)
+    if local_result is not None:
+        print(f"   -> Falling back to local classifier answer ({prediction.disease_name}, {prediction.confidence}).")
+        metrics.ANALYSIS_SOURCES.inc("fallback")
+        return local_result, prediction._replace(features=None, served_locally=True)
+    if not guides:
+        return None
+    print("   -> Falling back to knowledge-base guidance.")
+    metrics.ANALYSIS_SOURCES.inc("guides")
+    online_result = await run_in_threadpool(agent.rag_only_result, user_query, local_context, crop_type)
+    return online_result, prediction._replace(features=None)
+
+
+async def _run_analysis(
+    image_data: bytes,
+    user_query: str,
+    language_code: str,
+    db: AsyncSession,
+    current_user: models.User,
+    wait_for_model: bool = False
+) -> dict:
+    """Shared analysis pipeline for the analyze endpoints and the job workers."""
+    # Step 1: Get the user's farm
+    db_farm = await _get_user_farm(db, current_user)
+
+    # Step 2: Analyse the photo (cache, local classifier, image preparation, agent),
+    # storing it in the blob store meanwhile
+    (online_result, prediction), image_url = await asyncio.gather(
+        _analyze_photo(image_data, user_query, language_code, db, db_farm, wait_for_model=wait_for_model),
+        _store_image(image_data, current_user.id)
+    )
+
     # Step 3: Save result to DB
-    result_to_save = schemas.AnalysisResultCreate(
-        user_query=request.userQuery,
-        offline_disease_name="Unknown",
-        offline_confidence_score=0.0,
-        online_disease_name=online_result.get("diseaseName"),
-        online_severity=online_result.get("severity"),
-        online_summary=online_result.get("summary"),
-        online_recommended_actions=online_result.get("recommendedActions"),
-        online_scientific_reason=online_result.get("scientificReason"),
-        online_preventative_measures=online_result.get("preventativeMeasures")
+    result_to_save = _analysis_result_to_save(user_query, online_result, prediction, language_code, image_url)
+    await _save_analysis_result(db, result_to_save, user_id=current_user.id, farm_id=db_farm.id)
+
+    return {"onlineResult": online_result, "offlineResult": _offline_result(prediction), "imageUrl": image_url}
+
+
+@app.post("/api/v1/analyze")
+async def analyze_image(
+    request: AnalysisRequest, 
+    db: AsyncSession = Depends(get_async_db), 
+    current_user: models.User = Depends(security.get_current_user)
+):
+    try:
+        image_data = agent.decode_image_data(request.image)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image data.")
+    return await _run_analysis(image_data, request.userQuery, request.languageCode, db, current_user)
+
+
+@app.post("/api/v1/analyze/upload")
+async def analyze_uploaded_image(
+    image: UploadFile = File(...),
+    userQuery: str = Form(""),
+    languageCode: str = Form("en"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(security.get_current_user)
+):
+    """Same as /api/v1/analyze, but takes the photo as a multipart file instead of a base64 string."""
+    image_data = await image.read(imaging.MAX_UPLOAD_BYTES + 1)
+    if len(image_data) > imaging.MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image is too large.")
+    return await _run_analysis(image_data, userQuery, agent.normalize_language_code(languageCode), db, current_user)
+
+
+# Groups of result fields pushed as SSE events, in the order the farmer needs them
+STREAM_EVENT_FIELDS = [
+    ("diagnosis", ("diseaseName", "severity")),
+    ("summary", ("summary",)),
+    ("actions", ("recommendedActions",)),
+    ("reason", ("scientificReason",)),
+    ("prevention", ("preventativeMeasures",)),
+]
+REQUIRED_RESULT_FIELDS = [field for _, fields in STREAM_EVENT_FIELDS for field in fields]
+
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/api/v1/analyze/stream")
+async def analyze_image_stream(
+    request: AnalysisRequest,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(security.get_current_user)
+):
+    """
+    Streams the analysis as Server-Sent Events: 'diagnosis' (name and severity)
+    as soon as Gemini has produced it, then 'summary', 'actions', 'reason' and
+    'prevention', and finally 'result' with the validated object once it has
+    been saved. Failures after the stream has started arrive as an 'error' event.
+    """
+    try:
+        image_data = agent.decode_image_data(request.image)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image data.")
+
+    db_farm = await _get_user_farm(db, current_user)
+    stored_image = asyncio.ensure_future(_store_image(image_data, current_user.id))
+    farm_id, crop_type = db_farm.id, db_farm.crop_type
+    farm_details = {"location": db_farm.location, "crop_type": crop_type, "name": db_farm.name}
+    user_id = current_user.id
+
+    cache_key = None
+    cached_result = None
+    if analysis_cache.CACHE_ENABLED:
+        with metrics.timed("cache_lookup"):
+            try:
+                cache_key = await run_in_threadpool(
+                    analysis_cache.make_cache_key, image_data, request.userQuery, crop_type, request.languageCode
+                )
+            except Exception:
+                raise HTTPException(status_code=400, detail="Invalid image data.")
+            cached_result = await db.run_sync(analysis_cache.cache.get, cache_key)
+    prediction = await _classify_photo(image_data, db)
+    if cached_result is not None:
+        metrics.ANALYSIS_SOURCES.inc("cache")
+        prediction = prediction._replace(features=None)
+    else:
+        if _may_short_circuit(request.languageCode):
+            cached_result = await _local_answer(prediction, crop_type, classifier.SHORT_CIRCUIT_CONFIDENCE)
+        if cached_result is not None:
+            metrics.ANALYSIS_SOURCES.inc("local")
+            prediction = prediction._replace(features=None, served_locally=True)
+    await db.commit()  # The stream can take a while; don't hold a pooled connection
+
+    chunks = None
+    if cached_result is None:
+        try:
+            with metrics.timed("image_prepare"):
+                prepared_image = await run_in_threadpool(imaging.prepare_image, image_data)
+        except imaging.InvalidImageError:
+            raise HTTPException(status_code=400, detail="Invalid image data.")
+        try:
+            chunks = await agent.stream_analysis_agent_async(
+                image_data=prepared_image,
+                user_query=request.userQuery,
+                farm_details=farm_details,
+                language_code=request.languageCode,
+                mime_type=imaging.prepared_mime_type()
+            )
+        except agent.AgentBusyError as e:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=str(e),
+                headers={"Retry-After": str(e.retry_after)}
+            )
+        except resilience.CircuitOpenError as e:
+            fallback = await _fallback_answer(db, prediction, request.languageCode, request.userQuery, crop_type=crop_type)
+            if fallback is None:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail=str(e),
+                    headers={"Retry-After": str(e.retry_after)}
+                )
+            cached_result, prediction = fallback
+
+    async def event_stream():
+        sent = set()
+
+        def ready_events(fields: dict):
+            for event, names in STREAM_EVENT_FIELDS:
+                if event not in sent and all(name in fields for name in names):
+                    sent.add(event)
+                    yield _sse_event(event, {name: fields[name] for name in names})
+
+        if cached_result is not None:
+            online_result = cached_result
+            for event in ready_events(online_result):
+                yield event
+        else:
+            started = time.perf_counter()
+            parser = agent.StreamingResultParser()
+            try:
+                async for text in chunks:
+                    parser.feed(text)
+                    for event in ready_events(parser.fields):
+                        yield event
+            except Exception:
+                yield _sse_event("error", {"detail": "Failed to get analysis from AI. Please try again."})
+                return
+            # The headers are long gone, so the stream's timings only reach /metrics
+            metrics.record("model_call", time.perf_counter() - started)
+
+            try:
+                with metrics.timed("parse"):
+                    online_result = parser.result()
+                missing = [name for name in REQUIRED_RESULT_FIELDS if name not in online_result]
+            except ValueError:
+                online_result, missing = {}, ["<unparseable reply>"]
+            if missing:
+                metrics.PARSE_FAILURES.inc("stream")
+                print(f"   -> Streamed analysis is missing fields: {missing}")
+                yield _sse_event("error", {"detail": "Failed to get analysis from AI. Please try again."})
+                return
+            metrics.ANALYSIS_SOURCES.inc("model")
+            for event in ready_events(online_result):
+                yield event
+
+        # Persist with a fresh session; the request's session may already be closed
+        async with AsyncSessionLocal() as stream_db:
+            if cached_result is None and cache_key:
+                latency_ms = (time.perf_counter() - started) * 1000
+                await stream_db.run_sync(analysis_cache.cache.put, cache_key, online_result, latency_ms)
+            image_url = await stored_image
+            result_to_save = _analysis_result_to_save(
+                request.userQuery, online_result, prediction, request.languageCode, image_url
+            )
+            await _save_analysis_result(stream_db, result_to_save, user_id=user_id, farm_id=farm_id)
+
+        yield _sse_event("result", {
+            "onlineResult": online_result, "offlineResult": _offline_result(prediction), "imageUrl": image_url
+        })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
-    crud.create_analysis_result(db=db, result=result_to_save, user_id=current_user.id, farm_id=db_farm.id)
 
-    return {"onlineResult": online_result}
+
+@app.post("/api/v1/analyze/batch")
+async def analyze_batch(
+    request: BatchAnalysisRequest,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(security.get_current_user)
+):
+    """
+    Analyses a field survey of photos in one call. The user, farm and RAG context
+    (once per distinct query) are resolved up front, the photos are analysed
+    concurrently, and every successful result is saved in a single transaction.
+    Failed photos are reported per item instead of failing the whole batch.
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="The batch contains no images.")
+    if len(request.items) > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"A batch can contain at most {BATCH_MAX_IMAGES} images.")
+
+    db_farm = await _get_user_farm(db, current_user)
+    await db.commit()
+
+    contexts = {}
+    for query in {item.userQuery for item in request.items}:
+        contexts[query] = await run_in_threadpool(agent.retrieve_local_context, query, db_farm.crop_type)
+
+    batch_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def analyze_item(item: BatchAnalysisItem) -> dict:
+        # Each item gets its own session: an AsyncSession can't be shared by concurrent tasks
+        async with batch_slots, AsyncSessionLocal() as item_db:
+            image_data = agent.decode_image_data(item.image)
+            (online_result, prediction), image_url = await asyncio.gather(
+                _analyze_photo(
+                    image_data, item.userQuery, request.languageCode, item_db, db_farm,
+                    local_context=contexts[item.userQuery], wait_for_model=True
+                ),
+                _store_image(image_data, current_user.id)
+            )
+            return online_result, prediction, image_url
+
+    outcomes = await asyncio.gather(*(analyze_item(item) for item in request.items), return_exceptions=True)
+
+    results, to_save = [], []
+    for index, (item, outcome) in enumerate(zip(request.items, outcomes)):
+        if isinstance(outcome, HTTPException):
+            results.append({"index": index, "error": outcome.detail, "status": outcome.status_code})
+        elif isinstance(outcome, Exception):
+            detail = "Invalid image data." if isinstance(outcome, ValueError) else "Failed to get analysis from AI. Please try again."
+            results.append({"index": index, "error": detail, "status": 400 if isinstance(outcome, ValueError) else 500})
+        else:
+            online_result, prediction, image_url = outcome
+            results.append({
+                "index": index,
+                "onlineResult": online_result,
+                "offlineResult": _offline_result(prediction),
+                "imageUrl": image_url
+            })
+            to_save.append(_analysis_result_to_save(
+                item.userQuery, online_result, prediction, request.languageCode, image_url
+            ))
+
+    if to_save:
+        with metrics.timed("db_write"):
+            await db.run_sync(crud.create_analysis_results, results=to_save, user_id=current_user.id, farm_id=db_farm.id)
+
+    return {"results": results, "succeeded": len(to_save), "failed": len(results) - len(to_save)}
+
+
+# --- Analysis Jobs ---
+async def _process_analysis_job(job: jobs.AnalysisJob) -> dict:
+    async with AsyncSessionLocal() as db:
+        return await _run_analysis(
+            job.image_data, job.user_query, job.language_code, db, job.owner, wait_for_model=True
+        )
+
+
+def _get_own_job(job_id: str, current_user: models.User) -> jobs.AnalysisJob:
+    job = jobs.queue.get(job_id)
+    if job is None or job.owner.id != current_user.id:
+        raise HTTPException(status_code=404, detail="Analysis job not found.")
+    return job
+
+
+@app.post("/api/v1/analyze/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_analysis_job(
+    request: AnalysisRequest,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(security.get_current_user)
+):
+    """Queues an analysis and returns immediately; poll or subscribe for the result."""
+    await _get_user_farm(db, current_user)
+    try:
+        image_data = agent.decode_image_data(request.image)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image data.")
+
+    try:
+        job = jobs.queue.submit(current_user, image_data, request.userQuery, request.languageCode)
+    except jobs.QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(agent.MODEL_RETRY_AFTER)}
+        )
+
+    return {
+        **job.to_dict(),
+        "statusUrl": f"/api/v1/analyze/{job.id}",
+        "eventsUrl": f"/api/v1/analyze/{job.id}/events"
+    }
+
+
+@app.get("/api/v1/analyze/{job_id}")
+async def read_analysis_job(job_id: str, current_user: models.User = Depends(security.get_current_user)):
+    return _get_own_job(job_id, current_user).to_dict()
+
+
+@app.get("/api/v1/analyze/{job_id}/events")
+async def stream_analysis_job(job_id: str, current_user: models.User = Depends(security.get_current_user)):
+    """Server-Sent Events: one 'status' event per state change, ending when the job finishes."""
+    job = _get_own_job(job_id, current_user)
+
+    async def event_stream():
+        while True:
+            seen_status = job.status
+            yield f"event: status\ndata: {json.dumps(job.to_dict())}\n\n"
+            if job.finished:
+                return
+            # Comment lines keep idle mobile connections from being dropped
+            while not await job.wait_for_change(seen_status, timeout=15):
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# --- History Endpoints ---
+HISTORY_MAX_PAGE_SIZE = 100
+
+
+def _encode_history_cursor(cursor: tuple) -> str:
+    timestamp, result_id = cursor
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{result_id}".encode()).decode()
+
+
+def _decode_history_cursor(cursor: str) -> tuple:
+    try:
+        timestamp, result_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(result_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid history cursor.")
+
+
+# Bump when the history response shape changes, so clients drop their cached pages
+HISTORY_REPRESENTATION = 3
+
+
+def _read_history_page(
+    db: Session,
+    request: Request,
+    user_id: int,
+    limit: int,
+    cursor: Optional[str],
+    summary: bool
+) -> Response:
+    before = _decode_history_cursor(cursor) if cursor else None
+
+    # The ETag comes from one aggregate over the owner index, so an unchanged
+    # page is answered with a 304 without reading or serializing any rows.
+    # There is no Last-Modified: with write-behind, timestamps are taken when a
+    # row is queued, so a row committed later can be older than a client's date.
+    count, latest_id = crud.get_analysis_history_version(db, user_id)
+    etag = responses.make_etag(HISTORY_REPRESENTATION, user_id, count, latest_id, limit, cursor, summary)
+    headers = responses.validator_headers(etag)
+    if responses.is_not_modified(request, etag):
+        return responses.not_modified(headers)
+
+    page, next_cursor = crud.get_analysis_history_page(
+        db,
+        user_id=user_id,
+        limit=limit,
+        before=before,
+        summary=summary
+    )
+    # List views show the thumbnail; image_url is the full photo
+    for row in page:
+        row["thumbnail_url"] = blobstore.thumbnail_url(row["image_url"])
+    # The body stays a plain list; the next page is announced in a header
+    if next_cursor:
+        headers["X-Next-Cursor"] = _encode_history_cursor(next_cursor)
+    return responses.FastJSONResponse(page, headers=headers)
 
 
 @app.get("/api/v1/history/me", response_model=List[schemas.AnalysisResult])
 def read_my_analysis_history(
+    request: Request,
+    limit: int = Query(HISTORY_MAX_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(security.get_current_user)
+):
+    """
+    Newest-first history. Pass the X-Next-Cursor response header back as
+    `cursor` for the next page, and the ETag in If-None-Match to get a 304.
+    """
+    return _read_history_page(db, request, current_user.id, limit, cursor, summary=False)
+
+
+@app.get("/api/v1/history/me/summary", response_model=List[schemas.AnalysisSummary])
+def read_my_analysis_history_summary(
+    request: Request,
+    limit: int = Query(HISTORY_MAX_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(security.get_current_user)
+):
+    """Same paging as /api/v1/history/me, without the recommended actions and preventative measures."""
+    return _read_history_page(db, request, current_user.id, limit, cursor, summary=True)
+
+
+@app.post("/api/v1/history/{analysis_id}/confirm")
+def confirm_diagnosis(
+    analysis_id: int,
+    confirmation: DiagnosisConfirmation,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(security.get_current_user)
 ):
-    history = crud.get_analysis_history_for_user(db, user_id=current_user.id)
-    return history
+    """
+    Confirms (or corrects) the diagnosis of one of your analyses. Only confirmed
+    diagnoses train the local classifier.
+    """
+    confirmed = crud.confirm_analysis(db, analysis_id, current_user.id, confirmation.diseaseName)
+    if confirmed is None:
+        raise HTTPException(status_code=404, detail="Analysis not found.")
+    db_result, features = confirmed
+    if classifier.CLASSIFIER_ENABLED and features is not None:
+        # Reload rather than learn(): a correction replaces the sample's earlier label
+        classifier.model.refresh(db, force=True)
+    return {"id": db_result.id, "confirmedDiseaseName": db_result.confirmed_disease_name}
+
+
+# --- Images ---
+# Stored photos never change (the key is their content hash), so clients may
+# keep them for a year; ranges let the app resume or preview large originals.
+# The signed token in the URL is the access check (see blobstore.image_token).
+IMAGE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def _image_response(request: Request, token: str, variant: str) -> Response:
+    key = blobstore.key_from_token(token)
+    blob = blobstore.store.locate(key, variant) if key else None
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Image not found.")
+    etag = f'"{key}-{variant}"'
+    last_modified = datetime.fromtimestamp(blob.modified, timezone.utc)
+    headers = {"ETag": etag, "Last-Modified": responses.http_date(last_modified), "Cache-Control": IMAGE_CACHE_CONTROL}
+    if responses.is_not_modified(request, etag, last_modified):
+        return responses.not_modified(headers)
+    # FileResponse streams the file in chunks and answers Range requests with 206
+    return FileResponse(blob.path, media_type=blob.content_type, headers=headers)
+
+
+@app.get("/api/v1/images/{token}")
+def read_image(token: str, request: Request):
+    """A stored photo, by the signed token in an analysis' image_url."""
+    return _image_response(request, token, blobstore.ORIGINAL)
+
+
+@app.get("/api/v1/images/{token}/thumbnail")
+def read_image_thumbnail(token: str, request: Request):
+    """The small JPEG version of a stored photo, for list views."""
+    return _image_response(request, token, blobstore.THUMBNAIL)
+
+
+_import_finished = time.perf_counter()
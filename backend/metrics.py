@@ -0,0 +1,251 @@
+# backend/metrics.py
+
+import os
+import hmac
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Metrics Settings ---
+# In-process counters and histograms rendered in the Prometheus text format at
+# /metrics. Each uvicorn worker keeps its own numbers, so scrape workers
+# individually (or run one worker per container). Recording an observation
+# costs a lock and a bisect, cheap enough to leave on in production.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Bearer token for Prometheus (authorization: credentials: ...); a signed-in
+# user's token is accepted too
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Only these paths get a Server-Timing header
+SERVER_TIMING_PREFIX = "/api/v1/analyze"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def is_scrape_token(token: str) -> bool:
+    return bool(METRICS_TOKEN) and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, *labels, amount: float = 1.0):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value: float, *labels):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collect):
+        """
+        collect() returns (name, kind, documentation, samples) tuples, where
+        samples is a list of ({label: value}, number); used for gauges that are
+        read from other modules' stats() when /metrics is scraped.
+        """
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"   -> ERROR collecting metrics: {e}")
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# --- Application Metrics ---
+STAGE_SECONDS = Histogram(
+    "ceres_stage_duration_seconds",
+    "Time spent in each step of a request (auth, farm_lookup, cache_lookup, classify, image_decode, "
+    "image_prepare, retrieval, model_call, parse, blob_store, db_write).",
+    ("stage",),
+)
+REQUEST_SECONDS = Histogram(
+    "ceres_http_request_duration_seconds", "HTTP request latency by route.", ("method", "route", "status")
+)
+MODEL_ERRORS = Counter("ceres_model_errors_total", "Gemini calls that raised an error.", ("mode",))
+PARSE_FAILURES = Counter("ceres_model_parse_failures_total", "Gemini replies that were not the expected JSON.", ("mode",))
+MODEL_REJECTIONS = Counter("ceres_model_rejections_total", "Analyses turned away because every model slot was busy.")
+MODEL_RETRIES = Counter("ceres_model_retries_total", "Gemini calls retried after a transient error.")
+MODEL_COALESCED = Counter("ceres_model_coalesced_total", "Analyses that shared an identical in-flight Gemini call.")
+CIRCUIT_REJECTIONS = Counter("ceres_model_circuit_rejections_total", "Gemini calls skipped because the circuit was open.")
+ANALYSIS_SOURCES = Counter(
+    "ceres_analysis_results_total",
+    "Analyses by where the answer came from (cache, local, model, fallback, guides).",
+    ("source",),
+)
+PROMPT_TOKENS = Histogram(
+    "ceres_prompt_tokens",
+    "Estimated tokens per Gemini prompt: the knowledge-base context, and the whole text prompt.",
+    ("part",),
+    buckets=(50, 100, 200, 300, 400, 500, 600, 800, 1000, 1500, 2000, 4000),
+)
+
+
+# --- Per-Request Stage Timings ---
+# The list of (stage, seconds) for the current request, shown in its
+# Server-Timing header, along with (name, count) annotations such as token
+# counts (ints, where timings are floats). Thread pool helpers copy the
+# context, so stages timed off the event loop land in the same list.
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def record(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+def annotate(name: str, count: int):
+    """Adds a count (summed per request) to the current request's Server-Timing header."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, int(count)))
+
+
+@contextmanager
+def timed(stage: str):
+    """Times the block as one `stage` of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+
+def _server_timing(timings: list, total: float) -> str:
+    merged = {}
+    for stage, value in timings:
+        merged[stage] = merged.get(stage, 0) + value
+    entries = [
+        f'{stage};desc="{value}"' if isinstance(value, int) else f"{stage};dur={value * 1000:.1f}"
+        for stage, value in merged.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware (no per-request task or body buffering) that records
+    request latency per route and adds a Server-Timing header to analyze calls.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        timings = [] if scope["path"].startswith(SERVER_TIMING_PREFIX) else None
+        token = _request_timings.set(timings)
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if timings is not None:
+                    header = _server_timing(timings, time.perf_counter() - started)
+                    message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started, scope["method"], getattr(route, "path", "unmatched"), str(status_code)
+            )
+
+
+def render_latest() -> str:
+    return registry.render()
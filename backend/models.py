@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, JSON
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, JSON, Index, LargeBinary
+from sqlalchemy.orm import relationship, deferred
 from database import Base
 import datetime
 
@@ -21,8 +21,17 @@ class Farm(Base):
     crop_type = Column(String) # e.g., "Robusta", "Arabica"
     owner_id = Column(Integer, ForeignKey("users.id"))
 
+    # Typed copy of `location` and its grid cell (see geo.py), for regional queries
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    cell_lat = Column(Integer, nullable=True)
+    cell_lon = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
     owner = relationship("User", back_populates="farms")
 
+Index("ix_farms_cell", Farm.cell_lat, Farm.cell_lon)
+
 class AnalysisResult(Base):
     __tablename__ = "analysis_results"
 
@@ -30,10 +39,16 @@ class AnalysisResult(Base):
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     image_url = Column(String, nullable=True) # We'll store the image URL here later
     user_query = Column(String, nullable=True)
+    language_code = Column(String(8), nullable=True)
 
     # Store the simple offline result
     offline_disease_name = Column(String)
     offline_confidence_score = Column(Float)
+    # float32 colour/texture features (see classifier.py); only set on rows
+    # diagnosed by Gemini. Once the diagnosis is confirmed (confirmed_disease_name)
+    # the row becomes a training sample of the local classifier.
+    image_features = deferred(Column(LargeBinary, nullable=True))
+    confirmed_disease_name = Column(String, nullable=True)
 
     # Store the detailed online result from Gemini
     online_disease_name = Column(String)
@@ -45,4 +60,32 @@ class AnalysisResult(Base):
 
     # Relationships
     owner_id = Column(Integer, ForeignKey("users.id"))
-    farm_id = Column(Integer, ForeignKey("farms.id"))
\ No newline at end of file
+    farm_id = Column(Integer, ForeignKey("farms.id"))
+
+# Serves the newest-first, keyset-paginated history of one user without a sort
+Index(
+    "ix_analysis_results_owner_timestamp_id",
+    AnalysisResult.owner_id,
+    AnalysisResult.timestamp.desc(),
+    AnalysisResult.id.desc(),
+)
+
+class AnalysisCacheEntry(Base):
+    __tablename__ = "analysis_cache"
+
+    # sha256 of (image hash, normalized query, crop type, language)
+    key = Column(String(64), primary_key=True)
+    result = Column(JSON, nullable=False)
+    latency_ms = Column(Float)  # How long the model took to produce the result
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+class OutbreakRollup(Base):
+    """Diagnoses per grid cell, crop, disease and day, kept up to date as analyses are saved."""
+    __tablename__ = "outbreak_rollups"
+
+    cell_lat = Column(Integer, primary_key=True)
+    cell_lon = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    crop_type = Column(String, primary_key=True)
+    disease_name = Column(String, primary_key=True)
+    diagnoses = Column(Integer, nullable=False, default=0)
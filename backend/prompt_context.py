@@ -0,0 +1,200 @@
+# backend/prompt_context.py
+
+import os
+import re
+import math
+from typing import List, NamedTuple, Optional
+from dotenv import load_dotenv
+
+from rag_tool import tokenize
+
+load_dotenv()
+
+# --- Context Budget Settings ---
+# The guide chunks retrieved for a question run from one line to a whole page,
+# so the "local knowledge" part of the prompt is assembled to a token budget
+# instead of pasting the top hits whole: guides for other crops and
+# near-duplicate passages are dropped, and a long passage is cut down to the
+# sentences that share the most words with the question.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "450"))
+CONTEXT_MAX_PASSAGES = int(os.getenv("RAG_CONTEXT_MAX_PASSAGES", "3"))
+# Hits retrieved before filtering, so dropped ones can be replaced; farms
+# with a known crop fetch twice as many, since guides for other crops are
+# dropped before anything else
+CONTEXT_CANDIDATES = int(os.getenv("RAG_CONTEXT_CANDIDATES", "8"))
+# A passage longer than this is trimmed to its most relevant sentences
+PASSAGE_TOKEN_CAP = int(os.getenv("RAG_PASSAGE_TOKEN_CAP", "180"))
+# Share of the smaller passage's word trigrams the two must have in common to count as duplicates
+NEAR_DUPLICATE_OVERLAP = float(os.getenv("RAG_NEAR_DUPLICATE_OVERLAP", "0.6"))
+# Leftover budget below which no further (trimmed) passage is worth adding
+MIN_PASSAGE_TOKENS = 25
+# Gemini's tokenizer averages about four characters per token on English text;
+# counting exactly would cost a network call per prompt.
+CHARS_PER_TOKEN = 4.0
+
+SEPARATOR = "\n\n---\n\n"
+ELLIPSIS = " … "
+
+# Guides are matched to farms by the crop words in their file names; a guide
+# that names no crop (a fungicide label, say) applies to every farm.
+CROP_WORDS = {
+    "coffee": "coffee", "robusta": "coffee", "arabica": "coffee",
+    "pepper": "pepper", "arecanut": "arecanut", "areca": "arecanut", "cardamom": "cardamom",
+}
+
+# Words too common in questions to say which sentence answers them
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "i", "in", "is",
+    "it", "its", "my", "of", "on", "or", "the", "there", "these", "this", "to", "what", "with",
+}
+_SENTENCE_BREAK_RE = re.compile(r'(?<=[.!?;])\s+')
+
+
+class Passage(NamedTuple):
+    source: str
+    text: str
+    tokens: int
+    trimmed: bool
+
+
+class AssembledContext(NamedTuple):
+    text: str
+    passages: List[Passage]
+    tokens: int
+    budget: int
+    dropped: dict  # reason (off_crop, duplicate, over_budget) -> number of hits
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def crops_named(text: str) -> set:
+    """The crops (see CROP_WORDS) a crop type or guide file name mentions."""
+    return {CROP_WORDS[word] for word in tokenize(text.replace("_", " ")) if word in CROP_WORDS}
+
+
+def matches_crop(source: str, crop_type: Optional[str]) -> bool:
+    farm_crops = crops_named(crop_type or "")
+    guide_crops = crops_named(os.path.splitext(source)[0])
+    return not farm_crops or not guide_crops or bool(farm_crops & guide_crops)
+
+
+def candidate_count(crop_type: Optional[str]) -> int:
+    """How many hits to retrieve for a farm growing crop_type."""
+    return CONTEXT_CANDIDATES * 2 if crops_named(crop_type or "") else CONTEXT_CANDIDATES
+
+
+def _shingles(text: str) -> set:
+    words = tokenize(text)
+    if len(words) < 3:
+        return set(words)
+    return set(zip(words, words[1:], words[2:]))
+
+
+def is_near_duplicate(shingles: set, kept: list) -> bool:
+    for other in kept:
+        smaller = min(len(shingles), len(other))
+        if smaller and len(shingles & other) / smaller >= NEAR_DUPLICATE_OVERLAP:
+            return True
+    return False
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    limit = int(max_tokens * CHARS_PER_TOKEN) - len(ELLIPSIS)
+    cut = text.rfind(" ", 0, limit)
+    return text[:cut if cut > 0 else limit].rstrip() + ELLIPSIS.rstrip()
+
+
+def trim_to_relevant(text: str, query_terms: set, max_tokens: int) -> str:
+    """
+    Keeps the sentences that share the most query terms (in their original
+    order, gaps marked with an ellipsis) within max_tokens. Sentences sharing
+    none are only used when no sentence matches at all.
+    """
+    sentences = [s for s in _SENTENCE_BREAK_RE.split(text) if s]
+    scores = [len(query_terms.intersection(tokenize(s))) for s in sentences]
+    ranked = sorted(range(len(sentences)), key=lambda i: (-scores[i], i))
+    if scores and scores[ranked[0]] > 0:
+        ranked = [i for i in ranked if scores[i] > 0]
+
+    chosen, used = [], 0
+    for i in ranked:
+        cost = estimate_tokens(sentences[i] + ELLIPSIS)
+        if used + cost <= max_tokens:
+            chosen.append(i)
+            used += cost
+    if not chosen:
+        return _truncate(sentences[ranked[0]], max_tokens) if ranked else ""
+
+    chosen.sort()
+    parts = [sentences[chosen[0]]]
+    for previous, i in zip(chosen, chosen[1:]):
+        parts.append((" " if i == previous + 1 else ELLIPSIS) + sentences[i])
+    return "".join(parts)
+
+
+def assemble_context(
+    query: str,
+    hits: list,
+    crop_type: Optional[str] = None,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    max_passages: int = CONTEXT_MAX_PASSAGES,
+) -> AssembledContext:
+    """
+    Builds the prompt's knowledge-base context from ranked rag_tool.Hits:
+    drops guides for other crops than crop_type (leaving the context empty
+    when none match, so off-crop advice is never offered as relevant), skips
+    passages that mostly repeat a better-ranked one, and trims passages to
+    their most relevant sentences so the whole stays within `budget`
+    estimated tokens.
+    """
+    dropped = {"off_crop": 0, "duplicate": 0, "over_budget": 0}
+    on_crop = [hit for hit in hits if matches_crop(hit.source, crop_type)]
+    dropped["off_crop"] = len(hits) - len(on_crop)
+    hits = on_crop
+
+    query_terms = set(tokenize(query)) - _STOPWORDS
+    separator_tokens = estimate_tokens(SEPARATOR)
+    passages, kept_shingles, used = [], [], 0
+    for hit in hits:
+        if len(passages) == max_passages:
+            break
+        text = " ".join(hit.text.split())
+        shingles = _shingles(text)
+        if is_near_duplicate(shingles, kept_shingles):
+            dropped["duplicate"] += 1
+            continue
+
+        allowed = min(PASSAGE_TOKEN_CAP, budget - used - (separator_tokens if passages else 0))
+        if allowed < MIN_PASSAGE_TOKENS:
+            dropped["over_budget"] += 1
+            continue
+        trimmed = estimate_tokens(text) > allowed
+        if trimmed:
+            text = trim_to_relevant(text, query_terms, allowed)
+        if not text:
+            continue
+
+        tokens = estimate_tokens(text)
+        used += tokens + (separator_tokens if passages else 0)
+        passages.append(Passage(hit.source, text, tokens, trimmed))
+        kept_shingles.append(shingles)
+
+    text = SEPARATOR.join(passage.text for passage in passages)
+    return AssembledContext(text, passages, estimate_tokens(text), budget, dropped)
+
+
+# --- Example Usage ---
+if __name__ == "__main__":
+    # python prompt_context.py "yellow powder under leaves" "Black Pepper"
+    import sys
+    from rag_tool import retrieve_chunks
+
+    query = sys.argv[1] if len(sys.argv) > 1 else "coffee leaf rust control"
+    crop_type = sys.argv[2] if len(sys.argv) > 2 else None
+    hits = retrieve_chunks(query, "knowledge_base", top_k=candidate_count(crop_type))
+    context = assemble_context(query, hits, crop_type)
+    whole = estimate_tokens(SEPARATOR.join(hit.text for hit in hits[:CONTEXT_MAX_PASSAGES]))
+    print(context.text)
+    print(f"\n{context.tokens}/{context.budget} tokens (top {CONTEXT_MAX_PASSAGES} hits whole: {whole}), dropped {context.dropped}")
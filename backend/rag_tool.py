@@ -1,67 +1,318 @@
 import os
 import re
-from collections import defaultdict
+import math
+import time
+import heapq
+import threading
+from collections import Counter, defaultdict
+from typing import NamedTuple
 
-def retrieve_context(query: str, knowledge_base_path: str, top_k: int = 3) -> str:
+# --- Index Settings ---
+MIN_PARAGRAPH_CHARS = 20  # Ignore very short paragraphs (headings, page numbers)
+# The guides are mostly hard-wrapped lines without blank lines between them, so
+# long paragraphs are cut into chunks at line ends: preferably after a sentence
+# once CHUNK_TARGET_CHARS is reached, and always before CHUNK_MAX_CHARS.
+CHUNK_TARGET_CHARS = int(os.getenv("RAG_CHUNK_TARGET_CHARS", "600"))
+CHUNK_MAX_CHARS = int(os.getenv("RAG_CHUNK_MAX_CHARS", "1000"))
+# Stored with built indexes; chunk boundaries change whenever it does
+CHUNKER_SIGNATURE = f"{MIN_PARAGRAPH_CHARS}/{CHUNK_TARGET_CHARS}/{CHUNK_MAX_CHARS}"
+BM25_K1 = 1.5
+BM25_B = 0.75
+# How often (seconds) a query may trigger a check of the files' mtimes
+REFRESH_INTERVAL = float(os.getenv("RAG_REFRESH_INTERVAL", "30"))
+# "keyword" (BM25), "semantic" (rag_vectors embeddings) or "hybrid" (both)
+RAG_MODE = os.getenv("RAG_MODE", "keyword")
+# Share of the hybrid score that comes from the semantic similarity
+HYBRID_SEMANTIC_WEIGHT = float(os.getenv("RAG_HYBRID_WEIGHT", "0.5"))
+# "artifact" serves keyword search from the kb_index.py SQLite file; "memory"
+# parses the guides into this in-process index instead
+RAG_INDEX_BACKEND = os.getenv("RAG_INDEX_BACKEND", "artifact")
+
+_TOKEN_RE = re.compile(r'\b\w+\b')
+_PARAGRAPH_BREAK_RE = re.compile(r'\n[ \t]*\n')
+_SENTENCE_END = ('.', ':', ';', '!', '?')
+
+
+class Hit(NamedTuple):
+    """A ranked knowledge-base chunk and the guide (file name) it came from."""
+    score: float
+    text: str
+    source: str
+
+
+def tokenize(text: str) -> list:
+    """Lowercases the text and splits it into word tokens."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _stripped_span(content: str, start: int, end: int):
+    while start < end and content[start].isspace():
+        start += 1
+    while end > start and content[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def chunk_document(content: str) -> list:
+    """
+    Splits a document into (start, end) character spans: one per paragraph,
+    with long paragraphs cut at line ends. Spans shorter than
+    MIN_PARAGRAPH_CHARS are dropped.
+    """
+    spans = []
+
+    def emit(start, end):
+        start, end = _stripped_span(content, start, end)
+        if end - start >= MIN_PARAGRAPH_CHARS:
+            spans.append((start, end))
+
+    para_start = 0
+    for para_end in [m.start() for m in _PARAGRAPH_BREAK_RE.finditer(content)] + [len(content)]:
+        start, end = _stripped_span(content, para_start, para_end)
+        para_start = para_end
+        chunk_start = start
+        while end - chunk_start > CHUNK_MAX_CHARS:
+            limit = chunk_start + CHUNK_MAX_CHARS
+            cut = -1
+            line_end = content.find('\n', chunk_start, limit)
+            while line_end != -1:
+                if line_end - chunk_start >= CHUNK_TARGET_CHARS and content[chunk_start:line_end].rstrip().endswith(_SENTENCE_END):
+                    cut = line_end
+                    break
+                cut = line_end if line_end - chunk_start >= CHUNK_TARGET_CHARS or cut == -1 else cut
+                line_end = content.find('\n', line_end + 1, limit)
+            if cut == -1:
+                # One very long line: cut at the last space that fits
+                cut = content.rfind(' ', chunk_start + 1, limit)
+                cut = limit if cut == -1 else cut
+            emit(chunk_start, cut)
+            chunk_start = cut
+        emit(chunk_start, end)
+    return spans
+
+
+def bm25_score(tf: int, df: int, doc_count: int, length: int, avg_length: float) -> float:
+    """BM25 contribution of one query term that occurs tf times in a chunk."""
+    idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+    return idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+
+def split_paragraphs(content: str) -> list:
+    """Splits a document into stripped paragraph chunks (see chunk_document)."""
+    return [content[start:end] for start, end in chunk_document(content)]
+
+
+class KnowledgeBaseIndex:
     """
-    Searches through all.txt files, finds paragraphs containing query keywords,
-    scores them based on relevance, and returns the top_k most relevant paragraphs.
+    An in-memory inverted index over the paragraphs of every .txt file in a
+    knowledge-base folder. Paragraphs are ranked with BM25, so a query only
+    touches the postings of its own terms instead of scanning the whole corpus.
+    Files are re-indexed individually when their mtime changes.
     """
-    keywords = set(re.findall(r'\b\w+\b', query.lower()))
-    if not keywords:
-        return ""
 
-    scored_paragraphs = []
+    def __init__(self, knowledge_base_path: str):
+        self.knowledge_base_path = knowledge_base_path
+        self._lock = threading.Lock()
+        self._files = {}                   # filename -> (mtime, [doc_id, ...])
+        self._docs = {}                    # doc_id -> (paragraph, term counts, length, filename)
+        self._postings = defaultdict(dict)  # term -> {doc_id: term frequency}
+        self._total_length = 0
+        self._next_doc_id = 0
+        self._last_refresh = 0.0
+
+    # --- Building ---
+    def refresh(self, force: bool = False):
+        """Re-indexes files that were added, changed or removed since the last refresh."""
+        now = time.monotonic()
+        if not force and self._last_refresh and now - self._last_refresh < REFRESH_INTERVAL:
+            return
 
-    for filename in os.listdir(knowledge_base_path):
-        if filename.endswith(".txt"):
-            file_path = os.path.join(knowledge_base_path, filename)
+        with self._lock:
+            self._last_refresh = now
+            current = {}
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    paragraphs = content.split('\n\n')
-                    
-                    for para in paragraphs:
-                        para_stripped = para.strip()
-                        if not para_stripped or len(para_stripped) < 20: # Ignore very short paragraphs
-                            continue
-                        
-                        para_lower = para_stripped.lower()
-                        
-                        # --- IMPROVED SCORING LOGIC ---
-                        # Count how many unique keywords from the query are in the paragraph
-                        unique_keywords_found = {kw for kw in keywords if kw in para_lower}
-                        
-                        # The score is the number of unique keywords found, squared.
-                        # This heavily rewards paragraphs that match more of the query.
-                        score = len(unique_keywords_found) ** 2
-                        
-                        if score > 0:
-                            scored_paragraphs.append((score, para_stripped))
-
-            except Exception as e:
-                print(f"Could not read file {filename}: {e}")
-
-    # Remove duplicate paragraphs before sorting
-    unique_paras = list(set(scored_paragraphs))
-    
-    # Sort all paragraphs by score in descending order
-    unique_paras.sort(key=lambda x: x, reverse=True)
-
-    # Get the text of the top_k paragraphs
-    top_paras = [para for score, para in unique_paras[:top_k]]
-
-    return "\n\n---\n\n".join(top_paras)
+                for entry in os.scandir(self.knowledge_base_path):
+                    if entry.name.endswith(".txt") and entry.is_file():
+                        current[entry.name] = entry.stat().st_mtime
+            except FileNotFoundError:
+                print(f"Knowledge base folder not found: {self.knowledge_base_path}")
+
+            for filename in list(self._files):
+                if filename not in current:
+                    self._remove_file(filename)
+
+            for filename, mtime in current.items():
+                indexed = self._files.get(filename)
+                if indexed is None or indexed[0] != mtime:
+                    self._remove_file(filename)
+                    self._add_file(filename, mtime)
+
+    def _add_file(self, filename: str, mtime: float):
+        file_path = os.path.join(self.knowledge_base_path, filename)
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except Exception as e:
+            print(f"Could not read file {filename}: {e}")
+            return
+
+        doc_ids = []
+        for para in split_paragraphs(content):
+            term_counts = Counter(tokenize(para))
+            if not term_counts:
+                continue
+            doc_id = self._next_doc_id
+            self._next_doc_id += 1
+            length = sum(term_counts.values())
+            self._docs[doc_id] = (para, term_counts, length, filename)
+            self._total_length += length
+            for term, tf in term_counts.items():
+                self._postings[term][doc_id] = tf
+            doc_ids.append(doc_id)
+        self._files[filename] = (mtime, doc_ids)
+
+    def _remove_file(self, filename: str):
+        indexed = self._files.pop(filename, None)
+        if indexed is None:
+            return
+        for doc_id in indexed[1]:
+            _, term_counts, length, _ = self._docs.pop(doc_id)
+            self._total_length -= length
+            for term in term_counts:
+                postings = self._postings[term]
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    # --- Querying ---
+    def search(self, query: str, top_k: int = 3) -> list:
+        """Returns up to top_k Hits ranked by BM25."""
+        self.refresh()
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self._lock:
+            doc_count = len(self._docs)
+            if doc_count == 0:
+                return []
+            avg_length = self._total_length / doc_count
+
+            scores = defaultdict(float)
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                for doc_id, tf in postings.items():
+                    scores[doc_id] += bm25_score(tf, df, doc_count, self._docs[doc_id][2], avg_length)
+
+            # The same paragraph can appear in several guides; keep its best score only
+            best = {}
+            for doc_id, score in scores.items():
+                para, _, _, filename = self._docs[doc_id]
+                if para not in best or score > best[para].score:
+                    best[para] = Hit(score, para, filename)
+
+        return heapq.nlargest(top_k, best.values(), key=lambda hit: hit.score)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(knowledge_base_path: str):
+    """
+    Returns the shared keyword index for a knowledge-base folder, opening the
+    on-disk artifact (see kb_index.py) on first use. Falls back to parsing the
+    guides in memory if the artifact can't be used.
+    """
+    key = os.path.abspath(knowledge_base_path)
+    index = _indexes.get(key)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(key)
+            if index is None:
+                if RAG_INDEX_BACKEND == "artifact":
+                    import sqlite3
+                    import kb_index
+                    try:
+                        index = kb_index.load_index(knowledge_base_path)
+                    except (OSError, sqlite3.Error) as e:
+                        print(f"Knowledge-base index unavailable ({e}); indexing in memory instead.")
+                if index is None:
+                    index = KnowledgeBaseIndex(knowledge_base_path)
+                    index.refresh(force=True)
+                _indexes[key] = index
+    return index
+
+
+def warm_up(knowledge_base_path: str, mode: str = None):
+    """Builds or loads every index the retrieval mode needs, so the first query doesn't pay for it."""
+    mode = mode or RAG_MODE
+    get_index(knowledge_base_path)
+    if mode != "keyword":
+        import rag_vectors
+        rag_vectors.get_vector_index(knowledge_base_path)
+
+
+def hybrid_search(query: str, knowledge_base_path: str, top_k: int = 3) -> list:
+    """
+    Merges the BM25 and embedding rankings. BM25 scores are scaled by the best
+    one so both signals fall in [0, 1] before they are weighted.
+    """
+    import rag_vectors
+    pool = top_k * 4
+    keyword_hits = get_index(knowledge_base_path).search(query, pool)
+    semantic_hits = rag_vectors.get_vector_index(knowledge_base_path).search(query, pool)
+
+    combined = defaultdict(float)
+    sources = {}
+    best_keyword = keyword_hits[0].score if keyword_hits else 0.0
+    for score, para, source in keyword_hits:
+        combined[para] += (1 - HYBRID_SEMANTIC_WEIGHT) * score / best_keyword
+        sources.setdefault(para, source)
+    for score, para, source in semantic_hits:
+        combined[para] += HYBRID_SEMANTIC_WEIGHT * score
+        sources.setdefault(para, source)
+    return [Hit(score, para, sources[para]) for para, score in heapq.nlargest(top_k, combined.items(), key=lambda x: x[1])]
+
+
+def retrieve_chunks(query: str, knowledge_base_path: str, top_k: int = 3, mode: str = None) -> list:
+    """
+    Returns the top_k knowledge-base chunks most relevant to the query as Hits,
+    ranked by BM25 keyword matches, embedding similarity, or both (RAG_MODE).
+    """
+    mode = mode or RAG_MODE
+    if mode == "semantic":
+        import rag_vectors
+        hits = rag_vectors.get_vector_index(knowledge_base_path).search(query, top_k)
+    elif mode == "hybrid":
+        hits = hybrid_search(query, knowledge_base_path, top_k)
+    else:
+        hits = get_index(knowledge_base_path).search(query, top_k)
+    return hits
+
+
+def retrieve_context(query: str, knowledge_base_path: str, top_k: int = 3, mode: str = None) -> str:
+    """The top_k chunks of retrieve_chunks, pasted together whole."""
+    hits = retrieve_chunks(query, knowledge_base_path, top_k, mode)
+    return "\n\n---\n\n".join(hit.text for hit in hits)
 
 # --- Example Usage (for testing) ---
 if __name__ == '__main__':
     # This will run only when you execute "python rag_tool.py"
     # Assumes you have a 'knowledge_base' folder in the same directory.
-    
+
     print("--- Testing for 'Bordeaux mixture preparation' ---")
     context = retrieve_context("Bordeaux mixture preparation", "knowledge_base")
     print(context if context else "No relevant context found.")
 
     print("\n--- Testing for 'Coffee Leaf Rust control' ---")
     context = retrieve_context("Coffee Leaf Rust control", "knowledge_base")
-    print(context if context else "No relevant context found.")
\ No newline at end of file
+    print(context if context else "No relevant context found.")
+
+    print("\n--- Testing for 'yellow powder under leaves' (hybrid) ---")
+    context = retrieve_context("yellow powder under leaves", "knowledge_base", mode="hybrid")
+    print(context[:300] if context else "No relevant context found.")
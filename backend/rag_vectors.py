@@ -0,0 +1,207 @@
+import os
+import json
+import math
+import zlib
+import shutil
+import tempfile
+import threading
+from collections import Counter
+
+import numpy as np
+
+from rag_tool import Hit, tokenize, split_paragraphs, CHUNKER_SIGNATURE
+
+# --- Vector Index Settings ---
+# Paragraphs are embedded with hashed TF-IDF features (word unigrams + bigrams)
+# projected onto their top LSA components, so related words ("yellow",
+# "powder", "rust", "pustules") land close together without any network model.
+HASH_DIM = int(os.getenv("RAG_VECTOR_HASH_DIM", "2048"))
+EMBEDDING_DIM = int(os.getenv("RAG_VECTOR_DIM", "128"))
+INDEX_DIRNAME = ".vectors"
+INDEX_VERSION = 2
+_BATCH_ROWS = 1024
+
+
+def _hashed_features(text: str) -> Counter:
+    tokens = tokenize(text)
+    features = Counter(tokens)
+    features.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    buckets = Counter()
+    for feature, count in features.items():
+        h = zlib.crc32(feature.encode("utf-8"))
+        sign = 1.0 if h & 0x80000000 else -1.0
+        buckets[h % HASH_DIM] += sign * (1.0 + math.log(count))
+    return buckets
+
+
+def _dense_rows(rows: list, idf: np.ndarray) -> np.ndarray:
+    """Turns sparse bucket->weight rows into L2-normalised TF-IDF rows."""
+    matrix = np.zeros((len(rows), idf.shape[0]), dtype=np.float32)
+    for i, buckets in enumerate(rows):
+        if buckets:
+            matrix[i, list(buckets.keys())] = list(buckets.values())
+    matrix *= idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _kb_fingerprint(knowledge_base_path: str) -> list:
+    entries = []
+    for entry in sorted(os.scandir(knowledge_base_path), key=lambda e: e.name):
+        if entry.name.endswith(".txt") and entry.is_file():
+            stat = entry.stat()
+            entries.append([entry.name, stat.st_size, stat.st_mtime])
+    return entries
+
+
+def build_vector_index(knowledge_base_path: str, index_dir: str = None) -> str:
+    """
+    Embeds every knowledge-base paragraph and writes the index to index_dir:
+    embeddings.npy (float32, one unit-length row per paragraph), projection.npy
+    and idf.npy (to embed queries), chunks.json and meta.json. The files are
+    written to a temporary folder and swapped in, so readers never see a
+    half-built index.
+    """
+    index_dir = index_dir or os.path.join(knowledge_base_path, INDEX_DIRNAME)
+    fingerprint = _kb_fingerprint(knowledge_base_path)
+
+    chunks, rows = [], []
+    for filename, _, _ in fingerprint:
+        with open(os.path.join(knowledge_base_path, filename), "r", encoding="utf-8") as f:
+            for para in split_paragraphs(f.read()):
+                chunks.append({"source": filename, "text": para})
+                rows.append(_hashed_features(para))
+
+    doc_freq = np.zeros(HASH_DIM, dtype=np.float32)
+    for buckets in rows:
+        doc_freq[list(buckets.keys())] += 1
+    idf = (np.log((1 + len(rows)) / (1 + doc_freq)) + 1).astype(np.float32)
+
+    # LSA via the eigenvectors of X^T X, accumulated batch by batch so the
+    # dense TF-IDF matrix never has to exist in full
+    covariance = np.zeros((HASH_DIM, HASH_DIM), dtype=np.float64)
+    for start in range(0, len(rows), _BATCH_ROWS):
+        batch = _dense_rows(rows[start:start + _BATCH_ROWS], idf)
+        covariance += batch.T.astype(np.float64) @ batch
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    dims = min(EMBEDDING_DIM, max(1, int((eigenvalues > 1e-9).sum())))
+    projection = np.ascontiguousarray(eigenvectors[:, ::-1][:, :dims], dtype=np.float32)
+
+    parent = os.path.dirname(os.path.abspath(index_dir))
+    tmp_dir = tempfile.mkdtemp(prefix=".vectors-", dir=parent)
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, "embeddings.npy"), mode="w+", dtype=np.float32, shape=(len(rows), dims)
+    )
+    for start in range(0, len(rows), _BATCH_ROWS):
+        projected = _dense_rows(rows[start:start + _BATCH_ROWS], idf) @ projection
+        norms = np.linalg.norm(projected, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings[start:start + len(projected)] = projected / norms
+    embeddings.flush()
+    del embeddings
+
+    np.save(os.path.join(tmp_dir, "projection.npy"), projection)
+    np.save(os.path.join(tmp_dir, "idf.npy"), idf)
+    with open(os.path.join(tmp_dir, "chunks.json"), "w", encoding="utf-8") as f:
+        json.dump(chunks, f)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": INDEX_VERSION, "hash_dim": HASH_DIM, "dims": dims,
+            "chunker": CHUNKER_SIGNATURE, "files": fingerprint,
+        }, f)
+
+    old_dir = None
+    if os.path.exists(index_dir):
+        old_dir = tempfile.mkdtemp(prefix=".vectors-old-", dir=parent)
+        os.replace(index_dir, os.path.join(old_dir, "index"))
+    os.replace(tmp_dir, index_dir)
+    if old_dir:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return index_dir
+
+
+class VectorIndex:
+    """
+    Read-only view of a built vector index. The embedding matrix is memory
+    mapped, so every uvicorn worker shares the same pages of the OS cache
+    instead of holding its own copy.
+    """
+
+    def __init__(self, index_dir: str):
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if (self.meta.get("version") != INDEX_VERSION or self.meta.get("hash_dim") != HASH_DIM
+                or self.meta.get("chunker") != CHUNKER_SIGNATURE):
+            raise ValueError(f"Vector index at {index_dir} was built with different settings")
+        with open(os.path.join(index_dir, "chunks.json"), "r", encoding="utf-8") as f:
+            self.chunks = json.load(f)
+        self.embeddings = np.load(os.path.join(index_dir, "embeddings.npy"), mmap_mode="r")
+        self.projection = np.load(os.path.join(index_dir, "projection.npy"), mmap_mode="r")
+        self.idf = np.load(os.path.join(index_dir, "idf.npy"))
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = _dense_rows([_hashed_features(text)], self.idf)[0] @ self.projection
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def search(self, query: str, top_k: int = 3) -> list:
+        """Returns up to top_k rag_tool.Hits scored by cosine similarity."""
+        if not len(self.chunks):
+            return []
+        query_vector = self.embed(query)
+        if not query_vector.any():
+            return []
+        scores = self.embeddings @ query_vector
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [Hit(float(scores[i]), self.chunks[i]["text"], self.chunks[i]["source"]) for i in top if scores[i] > 0]
+
+
+_vector_indexes = {}
+_vector_lock = threading.Lock()
+
+
+def get_vector_index(knowledge_base_path: str, build_if_missing: bool = True) -> VectorIndex:
+    """
+    Loads the vector index of a knowledge-base folder once per process. When it
+    is missing or the guides have changed since it was built, it is rebuilt
+    first (unless build_if_missing is False).
+    """
+    key = os.path.abspath(knowledge_base_path)
+    index = _vector_indexes.get(key)
+    if index is not None:
+        return index
+
+    with _vector_lock:
+        index = _vector_indexes.get(key)
+        if index is None:
+            index_dir = os.path.join(knowledge_base_path, INDEX_DIRNAME)
+            try:
+                index = VectorIndex(index_dir)
+                stale = index.meta.get("files") != _kb_fingerprint(knowledge_base_path)
+            except (FileNotFoundError, ValueError):
+                index, stale = None, True
+            if stale and build_if_missing:
+                print(f"Building vector index for {knowledge_base_path}...")
+                index = VectorIndex(build_vector_index(knowledge_base_path, index_dir))
+            if index is None:
+                raise FileNotFoundError(f"No vector index at {index_dir}; run 'python rag_vectors.py'")
+            _vector_indexes[key] = index
+    return index
+
+
+if __name__ == '__main__':
+    # Builds the index offline: python rag_vectors.py [knowledge_base_path]
+    import sys
+    import time
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "knowledge_base"
+    started = time.perf_counter()
+    out_dir = build_vector_index(path)
+    print(f"Vector index written to {out_dir} in {time.perf_counter() - started:.2f}s")
+
+    index = VectorIndex(out_dir)
+    for hit in index.search("yellow powder under leaves"):
+        print(f"{hit.score:.3f}  {hit.source}  {hit.text[:100]!r}")
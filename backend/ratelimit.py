@@ -0,0 +1,91 @@
+# backend/ratelimit.py
+
+import os
+import time
+import math
+import ipaddress
+import threading
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Login Limits ---
+# Every login attempt costs a bcrypt verification, so attempts are capped per
+# client IP (generous, officers often share one NAT) and per account.
+LOGIN_WINDOW_SECONDS = int(os.getenv("LOGIN_RATE_WINDOW", "60"))
+LOGIN_ATTEMPTS_PER_IP = int(os.getenv("LOGIN_ATTEMPTS_PER_IP", "60"))
+LOGIN_ATTEMPTS_PER_ACCOUNT = int(os.getenv("LOGIN_ATTEMPTS_PER_ACCOUNT", "10"))
+# Reverse proxies / load balancers (IPs or CIDRs, comma separated) whose
+# X-Forwarded-For is believed; without them every client behind the proxy
+# would share the proxy's bucket. Not needed when uvicorn already rewrites
+# the client address (--proxy-headers --forwarded-allow-ips).
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.getenv("TRUSTED_PROXIES", "").split(",") if entry.strip()
+]
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def client_ip(request) -> str:
+    """
+    The address the request came from: the peer, or, when the peer is a
+    trusted proxy, the right-most X-Forwarded-For entry that isn't one
+    (entries further left are set by the client and can be forged).
+    """
+    peer = request.client.host if request.client else "unknown"
+    if not _is_trusted_proxy(peer):
+        return peer
+    forwarded = [entry.strip() for entry in request.headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+    for address in reversed(forwarded):
+        if not _is_trusted_proxy(address):
+            return address
+    return forwarded[0] if forwarded else peer
+
+
+class SlidingWindowLimiter:
+    """Allows at most `limit` hits per key within any `window_seconds` period."""
+
+    def __init__(self, limit: int, window_seconds: int, max_keys: int = 100000):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._hits = OrderedDict()  # key -> deque of hit timestamps
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> int:
+        """
+        Records a hit for the key if it is within the limit and returns 0;
+        otherwise returns the number of seconds until the next hit is allowed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            hits = self._hits.get(key)
+            if hits is None:
+                hits = self._hits[key] = deque()
+            self._hits.move_to_end(key)
+            while hits and hits[0] <= now - self.window_seconds:
+                hits.popleft()
+
+            if len(hits) >= self.limit:
+                return max(1, math.ceil(hits[0] + self.window_seconds - now))
+
+            hits.append(now)
+            while len(self._hits) > self.max_keys:
+                self._hits.popitem(last=False)
+            return 0
+
+    def reset(self, key: str):
+        with self._lock:
+            self._hits.pop(key, None)
+
+
+login_ip_limiter = SlidingWindowLimiter(LOGIN_ATTEMPTS_PER_IP, LOGIN_WINDOW_SECONDS)
+login_account_limiter = SlidingWindowLimiter(LOGIN_ATTEMPTS_PER_ACCOUNT, LOGIN_WINDOW_SECONDS)
@@ -0,0 +1,219 @@
+# backend/resilience.py
+
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from typing import Awaitable, Callable, Hashable, Optional
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+# --- Retry Settings ---
+# A failed Gemini call is retried up to MODEL_MAX_ATTEMPTS times in total, with
+# full-jitter exponential backoff, as long as the whole analysis still fits in
+# MODEL_DEADLINE seconds. Client errors (bad request, auth) are not retried.
+MODEL_MAX_ATTEMPTS = int(os.getenv("MODEL_MAX_ATTEMPTS", "3"))
+MODEL_DEADLINE = float(os.getenv("MODEL_DEADLINE", "45"))
+RETRY_BASE_DELAY = float(os.getenv("MODEL_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("MODEL_RETRY_MAX_DELAY", "8"))
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# --- Circuit Breaker Settings ---
+# When at least CIRCUIT_ERROR_RATE of the last CIRCUIT_WINDOW calls (and no
+# fewer than CIRCUIT_MIN_CALLS) failed, Gemini is not called for
+# CIRCUIT_OPEN_SECONDS; then a single probe call decides whether to close again.
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the circuit breaker is open."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("The AI analysis service is temporarily unavailable. Please try again shortly.")
+        self.retry_after = retry_after
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether a failed call is worth retrying. Google API errors carry their HTTP
+    status in `code`; 4xx errors other than timeouts and rate limits will fail
+    the same way again, as will our own ValueError/TypeError bugs.
+    """
+    if isinstance(error, (ValueError, TypeError)):
+        return False
+    code = getattr(error, "code", None)
+    if isinstance(code, int) and 400 <= code < 500:
+        return code in RETRYABLE_STATUS_CODES
+    return True
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff before retry number `attempt` (1-based)."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+async def retry_with_backoff(
+    call: Callable[[float], Awaitable],
+    deadline: float = MODEL_DEADLINE,
+    max_attempts: int = MODEL_MAX_ATTEMPTS,
+    give_up_on: tuple = (),
+):
+    """
+    Awaits call(seconds_left) until it succeeds. Transient errors are retried
+    after a jittered backoff while attempts and the deadline allow; the last
+    error is raised otherwise. Exceptions in `give_up_on` are raised at once.
+    """
+    deadline_at = time.monotonic() + deadline
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return await call(max(0.0, deadline_at - time.monotonic()))
+        except give_up_on:
+            raise
+        except Exception as e:
+            delay = backoff_delay(attempt)
+            if attempt == max_attempts or not is_transient(e) or time.monotonic() + delay >= deadline_at:
+                raise
+            metrics.MODEL_RETRIES.inc()
+            print(f"   -> Retrying Gemini call in {delay:.2f}s (attempt {attempt + 1}/{max_attempts}) after: {e}")
+        await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker. Call before_call() ahead of every upstream
+    call (it raises CircuitOpenError while open) and then exactly one of
+    record_success() or record_failure(). Thread-safe, since streaming calls
+    finish on the model thread pool.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self,
+        window: int = CIRCUIT_WINDOW,
+        min_calls: int = CIRCUIT_MIN_CALLS,
+        error_rate: float = CIRCUIT_ERROR_RATE,
+        open_seconds: float = CIRCUIT_OPEN_SECONDS,
+    ):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self._outcomes = deque(maxlen=window)  # True for success
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        with self._lock:
+            if self._state == self.OPEN:
+                remaining = self.open_seconds - (time.monotonic() - self._opened_at)
+                if remaining > 0:
+                    self._reject(remaining)
+                self._state = self.HALF_OPEN
+                self._probing = False
+            if self._state == self.HALF_OPEN:
+                if self._probing:
+                    self._reject(self.open_seconds)
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                print("   -> Gemini circuit closed: the probe call succeeded.")
+                self._state = self.CLOSED
+                self._probing = False
+                self._outcomes.clear()
+            self._outcomes.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._open()
+                return
+            self._outcomes.append(False)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+                self._open()
+
+    def stats(self) -> dict:
+        state = self.state
+        with self._lock:
+            calls = len(self._outcomes)
+            failures = self._outcomes.count(False)
+            return {
+                "state": state,
+                "window_calls": calls,
+                "window_error_rate": round(failures / calls, 4) if calls else 0.0,
+                **self._stats,
+            }
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self._outcomes.clear()
+        self._stats["opened"] += 1
+        print(f"   -> Gemini circuit opened for {self.open_seconds:.0f}s after repeated failures.")
+
+    def _reject(self, retry_after: float):
+        self._stats["rejected"] += 1
+        metrics.CIRCUIT_REJECTIONS.inc()
+        raise CircuitOpenError(retry_after=max(1, int(retry_after + 0.999)))
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent work: while a call for a key is running,
+    later callers with the same key await its result instead of starting
+    their own. The call runs as its own task, so a caller that disconnects
+    doesn't cancel it for the others. Must be used from a single event loop.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._stats = {"calls": 0, "coalesced": 0}
+
+    async def do(self, key: Optional[Hashable], call: Callable[[], Awaitable]):
+        if key is None:
+            return await call()
+        task = self._flights.get(key)
+        if task is None:
+            self._stats["calls"] += 1
+            task = asyncio.ensure_future(call())
+            self._flights[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+        else:
+            self._stats["coalesced"] += 1
+            metrics.MODEL_COALESCED.inc()
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {**self._stats, "in_flight": len(self._flights)}
+
+    def _forget(self, key: Hashable, task: asyncio.Future):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # Nobody may be left to read the error of an abandoned flight
+        if not task.cancelled():
+            task.exception()
+
+
+breaker = CircuitBreaker()
+flights = SingleFlight()
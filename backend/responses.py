@@ -0,0 +1,98 @@
+# backend/responses.py
+
+import json
+import hashlib
+import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Optional: the standard library encoder is used instead
+    orjson = None
+
+
+# --- JSON Rendering ---
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    """Compact UTF-8 JSON; datetimes become ISO 8601 strings."""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson when it is installed. Endpoints can
+    return plain rows (dicts with datetimes) in one without a response_model
+    validation and jsonable_encoder pass.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+# --- Conditional GETs ---
+# Clients keep the body and revalidate on every refresh (no-cache); an
+# unchanged resource costs one cheap version lookup and an empty 304.
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    """A weak ETag from whatever identifies this version of the resource."""
+    return 'W/"' + hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=12).hexdigest() + '"'
+
+
+def http_date(value: datetime.datetime) -> str:
+    """Formats a (naive UTC) datetime as an HTTP date."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return format_datetime(value.astimezone(datetime.timezone.utc), usegmt=True)
+
+
+def _opaque_tag(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime.datetime] = None) -> bool:
+    """
+    Evaluates If-None-Match (weak comparison) or, when it is absent,
+    If-Modified-Since against the current validators.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {_opaque_tag(tag) for tag in if_none_match.split(",")}
+        return "*" in tags or _opaque_tag(etag) in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+        # HTTP dates have whole-second precision
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def validator_headers(etag: str, last_modified: Optional[datetime.datetime] = None) -> dict:
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Vary": "Authorization"}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
@@ -52,14 +52,33 @@ class AnalysisResultBase(BaseModel):
     online_preventative_measures: List[str]
 
 class AnalysisResultCreate(AnalysisResultBase):
-    pass
+    language_code: Optional[str] = None
+    image_url: Optional[str] = None
+    image_features: Optional[bytes] = None
 
 class AnalysisResult(AnalysisResultBase):
     id: int
     timestamp: datetime.datetime
     image_url: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    owner_id: int
+    farm_id: int
+    class Config:
+        from_attributes = True
+
+class AnalysisSummary(BaseModel):
+    """List-view projection of an analysis without the large JSON columns."""
+    id: int
+    timestamp: datetime.datetime
+    image_url: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    user_query: Optional[str] = None
+    offline_disease_name: Optional[str] = None
+    offline_confidence_score: Optional[float] = None
+    online_disease_name: Optional[str] = None
+    online_severity: Optional[str] = None
+    online_summary: Optional[str] = None
     owner_id: int
     farm_id: int
     class Config:
         from_attributes = True
-        
\ No newline at end of file
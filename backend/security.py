@@ -6,18 +6,34 @@ from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import os
+import asyncio
+import time
+import threading
 from dotenv import load_dotenv
 
 # Import necessary modules from our app
-import crud, models
+import crud, models, metrics
 from database import get_db
 
 # Load all environment variables from the.env file
 load_dotenv()
 
 # --- Password Hashing ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Changing BCRYPT_ROUNDS makes existing hashes "need update"; they are
+# re-hashed with the new cost the next time their owner logs in.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt is CPU-bound, so it runs on its own sized pool instead of the request
+# thread pool. "process" gives true parallelism across cores.
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+
+_hash_executor = None
+_hash_executor_lock = threading.Lock()
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -25,6 +41,35 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def verify_and_update_password(plain_password, hashed_password):
+    """Returns (is_valid, new_hash); new_hash is set when the stored hash uses an outdated cost."""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+def _get_hash_executor():
+    global _hash_executor
+    if _hash_executor is None:
+        with _hash_executor_lock:
+            if _hash_executor is None:
+                if PASSWORD_HASH_EXECUTOR == "process":
+                    _hash_executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+                else:
+                    _hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+    return _hash_executor
+
+async def get_password_hash_async(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_hash_executor(), get_password_hash, password)
+
+async def verify_and_update_password_async(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_hash_executor(), verify_and_update_password, plain_password, hashed_password)
+
+def shutdown_hash_executor():
+    global _hash_executor
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=False)
+        _hash_executor = None
+
 # --- JWT Token Handling ---
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
@@ -40,6 +85,72 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# --- Authenticated User Cache ---
+# Resolved users are cached by token subject so most requests skip the users
+# SELECT. Unknown subjects are cached too, for a shorter time. crud calls
+# invalidate_cached_user() whenever a user row is created or changed.
+USER_CACHE_TTL = int(os.getenv("AUTH_USER_CACHE_TTL", "300"))
+USER_CACHE_NEGATIVE_TTL = int(os.getenv("AUTH_USER_CACHE_NEGATIVE_TTL", "30"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_USER_CACHE_MAX_ENTRIES", "10000"))
+# Build the user from the token's own claims (uid, name) without touching the database
+TRUST_TOKEN_CLAIMS = os.getenv("AUTH_TRUST_TOKEN_CLAIMS", "0") == "1"
+
+_MISSING = object()
+
+
+class TTLCache:
+    """A small thread-safe LRU mapping whose entries expire after a per-entry TTL."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or _MISSING if the key is absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_user_cache = TTLCache(USER_CACHE_MAX_ENTRIES)
+
+
+def _user_snapshot(user: models.User) -> models.User:
+    # A detached copy, so a later commit on the request's session can't expire it
+    return models.User(id=user.id, name=user.name, email=user.email)
+
+
+def invalidate_cached_user(email: str):
+    """Drops the cached lookup for this email; call after creating or updating a user."""
+    _user_cache.pop(email)
+
+
+def clear_user_cache():
+    _user_cache.clear()
+
+
 # --- The "Get Current User" Dependency ---
 # This tells FastAPI which URL will be used to get the token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/token")
@@ -50,6 +161,11 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     and returns the corresponding user from the database.
     This is our main security dependency.
     """
+    with metrics.timed("auth"):
+        return _resolve_user(token, db)
+
+
+def _resolve_user(token: str, db: Session):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -62,8 +178,20 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    
-    user = crud.get_user_by_email(db, email=email)
+
+    if TRUST_TOKEN_CLAIMS and payload.get("uid") is not None:
+        return models.User(id=payload["uid"], name=payload.get("name"), email=email)
+
+    user = _user_cache.get(email)
+    if user is _MISSING:
+        db_user = crud.get_user_by_email(db, email=email)
+        if db_user is None:
+            user = None
+            _user_cache.put(email, None, USER_CACHE_NEGATIVE_TTL)
+        else:
+            user = _user_snapshot(db_user)
+            _user_cache.put(email, user, USER_CACHE_TTL)
+
     if user is None:
         raise credentials_exception
     return user
\ No newline at end of file
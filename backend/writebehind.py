@@ -0,0 +1,113 @@
+# backend/writebehind.py
+
+import os
+import asyncio
+import datetime
+from collections import deque
+from typing import Optional
+from dotenv import load_dotenv
+
+import crud, schemas
+from database import AsyncSessionLocal
+
+load_dotenv()
+
+# --- Write-Behind Settings ---
+# When enabled, analysis results are queued in memory and inserted in batches
+# by a background task, so the response no longer waits for a commit.
+WRITE_BEHIND_ENABLED = os.getenv("ANALYSIS_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("ANALYSIS_WRITE_BEHIND_BATCH_SIZE", "100"))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("ANALYSIS_WRITE_BEHIND_INTERVAL", "1.0"))
+WRITE_BEHIND_MAX_ATTEMPTS = 3
+
+
+class AnalysisWriter:
+    """
+    Buffers AnalysisResult rows and flushes them with one multi-row INSERT per
+    batch, whenever WRITE_BEHIND_BATCH_SIZE rows are waiting or every
+    WRITE_BEHIND_FLUSH_INTERVAL seconds. stop() lets the flush in progress
+    finish and then drains the buffer, retrying failed batches until their
+    attempts run out.
+    """
+
+    def __init__(self, batch_size: int = WRITE_BEHIND_BATCH_SIZE, flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = deque()  # (row, attempts)
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._stats = {"queued": 0, "written": 0, "flushes": 0, "failed_flushes": 0, "dropped": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Not cancel(): the loop exits between flushes, so no batch is cut off mid-insert
+            self._stopping = True
+            self._wake.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Every failed flush uses up an attempt of its rows, so this ends
+        while self._pending:
+            if not await self.flush():
+                await asyncio.sleep(min(self.flush_interval, 0.5))
+
+    def enqueue(self, result: schemas.AnalysisResultCreate, user_id: int, farm_id: int):
+        row = result.model_dump()
+        # Stamp the row now so history order reflects when the analysis happened
+        row.update(owner_id=user_id, farm_id=farm_id, timestamp=datetime.datetime.utcnow())
+        self._pending.append((row, 0))
+        self._stats["queued"] += 1
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> bool:
+        """Writes up to one batch; returns False if the insert failed."""
+        async with self._flush_lock:
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            if not batch:
+                return True
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.run_sync(crud.insert_analysis_rows, [row for row, _ in batch])
+            except asyncio.CancelledError:
+                # Cancelled mid-insert (the transaction was rolled back): keep the rows for the drain
+                self._pending.extendleft(reversed(batch))
+                raise
+            except Exception as e:
+                print(f"   -> ERROR writing {len(batch)} analysis results: {e}")
+                self._stats["failed_flushes"] += 1
+                for row, attempts in reversed(batch):
+                    if attempts + 1 < WRITE_BEHIND_MAX_ATTEMPTS:
+                        self._pending.appendleft((row, attempts + 1))
+                    else:
+                        self._stats["dropped"] += 1
+                return False
+            self._stats["flushes"] += 1
+            self._stats["written"] += len(batch)
+            return True
+
+    def stats(self) -> dict:
+        return {**self._stats, "pending": len(self._pending), "enabled": self.running}
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            while self._pending and not self._stopping:
+                if not await self.flush() or len(self._pending) < self.batch_size:
+                    break
+
+
+writer = AnalysisWriter()
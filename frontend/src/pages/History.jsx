@@ -133,11 +133,16 @@ const History = () => {
                     {status}
                   </span>
 
-                  <div className={`w-12 h-12 rounded-full flex items-center justify-center mb-4 ${ color === "green" ? "bg-green-900/50" : "bg-red-900/50" }`} >
-                    <svg className={`w-6 h-6 ${ color === "green" ? "text-green-400" : "text-red-400" }`} fill="none" stroke="currentColor" viewBox="0 0 24 24" >
-                      <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M12 2C8.134 2 5 5.134 5 9v5a7 7 0 0014 0V9c0-3.866-3.134-7-7-7z" />
-                    </svg>
-                  </div>
+                  {scan.thumbnail_url ? (
+                    // Thumbnails are ~10 KB JPEGs served through the /api proxy; the full photo is at scan.image_url
+                    <img src={scan.thumbnail_url} alt={name} loading="lazy" className="w-16 h-16 rounded-xl object-cover mb-4 border border-gray-700" />
+                  ) : (
+                    <div className={`w-12 h-12 rounded-full flex items-center justify-center mb-4 ${ color === "green" ? "bg-green-900/50" : "bg-red-900/50" }`} >
+                      <svg className={`w-6 h-6 ${ color === "green" ? "text-green-400" : "text-red-400" }`} fill="none" stroke="currentColor" viewBox="0 0 24 24" >
+                        <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M12 2C8.134 2 5 5.134 5 9v5a7 7 0 0014 0V9c0-3.866-3.134-7-7-7z" />
+                      </svg>
+                    </div>
+                  )}
 
                   <h3 className="text-xl font-semibold mb-1 text-white">{name}</h3>
                   <p className="text-sm text-gray-400 mb-3">📅 {date} • 🕒 {time}</p>